@@ -0,0 +1,260 @@
+# encoding: utf-8
+# 协议热点路径的微基准：固定随机种子生成输入，结果保存为JSON，并可与保存的基线对比，部署前发现性能回退
+# 用法: python Benchmark.py [-o result.json] [--baseline baseline.json] [--threshold 0.1] [--runs 10] [名称 ...]
+# 首次运行时用 -o baseline.json 保存基线，之后用 --baseline baseline.json 对比，有回退时退出码为1
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import timeit
+from time import time
+
+import MetadataInquirer
+from Spider import RECORDER_BATCH_SIZE, decode_name, flush_records, open_database
+from libs import decodeh, pymmh3
+from libs.bencode import bdecode, bencode
+from libs.bloomfilter import BloomFilter
+from libs.nodetable import KNode
+
+SEED = 0
+DEFAULT_RUNS = 10
+DEFAULT_THRESHOLD = 0.1  # 平均耗时比基线慢超过10%且超出两次测量的波动范围时视为回退
+TEMP_DIR = None  # recorder基准的临时数据库目录，运行期间创建，结束后删除
+
+
+def random_bytes(rng, n):
+    return ''.join(chr(rng.getrandbits(8)) for _ in xrange(n))
+
+
+def krpc_messages(rng):
+    """DHT中常见的几类KRPC消息，字段长度与实际抓包一致"""
+    nid, t, token = random_bytes(rng, 20), random_bytes(rng, 2), random_bytes(rng, 8)
+    nodes = random_bytes(rng, 26 * 8)
+    values = [random_bytes(rng, 6) for _ in xrange(8)]
+    return [
+        {'t': t, 'y': 'q', 'q': 'ping', 'a': {'id': nid}},
+        {'t': t, 'y': 'r', 'r': {'id': nid}},
+        {'t': t, 'y': 'q', 'q': 'find_node', 'a': {'id': nid, 'target': random_bytes(rng, 20)}},
+        {'t': t, 'y': 'r', 'r': {'id': nid, 'nodes': nodes}},
+        {'t': t, 'y': 'q', 'q': 'get_peers', 'a': {'id': nid, 'info_hash': random_bytes(rng, 20)}},
+        {'t': t, 'y': 'r', 'r': {'id': nid, 'token': token, 'values': values}},
+        {'t': t, 'y': 'q', 'q': 'announce_peer',
+         'a': {'id': nid, 'implied_port': 1, 'info_hash': random_bytes(rng, 20), 'port': 6881, 'token': token}},
+    ]
+
+
+def make_info(rng, file_count):
+    """构造info字典，pieces按总大小和piece长度生成，与真实种子的字节分布相近"""
+    name = 'benchmark torrent %d' % rng.getrandbits(32)
+    files = [{'length': rng.randint(1, 1 << 30), 'path': ['dir%d' % (i % 10), 'file%d.mkv' % i]}
+             for i in xrange(file_count)]
+    info = {'name': name, 'piece length': 1 << 20}
+    if file_count == 1:
+        info['length'] = files[0]['length']
+    else:
+        info['files'] = files
+    total = sum(item['length'] for item in files)
+    info['pieces'] = random_bytes(rng, 20 * min((total >> 20) + 1, 2000))
+    return bencode(info)
+
+
+def bench_bencode(rng, calls):
+    messages = krpc_messages(rng)
+    return lambda: [bencode(msg) for msg in messages]
+
+
+def bench_bdecode(rng, calls):
+    packets = [bencode(msg) for msg in krpc_messages(rng)]
+    return lambda: [bdecode(packet) for packet in packets]
+
+
+def bench_decode_nodes(rng, calls):
+    nodes = random_bytes(rng, 26 * 8)
+    return lambda: KNode.decode_nodes(nodes)
+
+
+def bench_encode_nodes(rng, calls):
+    nodes = [KNode(random_bytes(rng, 20), '.'.join(str(rng.randint(1, 254)) for _ in xrange(4)), rng.randint(1, 65535))
+             for _ in xrange(8)]
+    return lambda: KNode.encode_nodes(nodes)
+
+
+def bench_bloomfilter_add(rng, calls):
+    bloom_filter = BloomFilter(1 << 23, 7)
+    infohashes = [random_bytes(rng, 20) for _ in xrange(1000)]
+    return lambda: [bloom_filter.add(infohash) for infohash in infohashes]
+
+
+def bench_mmh3_hash(rng, calls):
+    keys = [random_bytes(rng, 20) for _ in xrange(100)]
+    return lambda: [pymmh3.hash(key) for key in keys]
+
+
+def bench_mmh3_hash128(rng, calls):
+    keys = [random_bytes(rng, 20) for _ in xrange(100)]
+    return lambda: [pymmh3.hash128(key) for key in keys]
+
+
+def bench_parse_metadata(rng, calls):
+    infos = [make_info(rng, 1), make_info(rng, 20), make_info(rng, 500)]
+    infohash = random_bytes(rng, 20)
+    return lambda: [MetadataInquirer.parse_metadata(infohash, info) for info in infos]
+
+
+def bench_decodeh(rng, calls):
+    # Spider.decode_name 中utf8、gb18030都失败时才会用到decodeh，这里取各种常见的非utf8编码的名称
+    names = [u'Caf\xe9 del Mar \xd1and\xfa'.encode('cp1252'), u'日本語のタイトル'.encode('shift_jis'),
+             u'한국어 제목'.encode('euc_kr'), u'Русский фильм'.encode('cp1251')]
+
+    def decode_all():
+        for name in names:
+            try:
+                decodeh.decode(name)
+            except UnicodeError:
+                pass
+
+    return decode_all
+
+
+def bench_recorder(rng, calls):
+    """
+    recorder的一次批量写入（与record_metadata相同的行转换 + flush_records），写入临时数据库
+    每次调用写入不同的新种子，批次在计时前全部生成好
+    """
+    sqlite_util = open_database(os.path.join(TEMP_DIR, 'benchmark.db'))
+    batches = []
+    for _ in xrange(calls):
+        batch = []
+        for _ in xrange(RECORDER_BATCH_SIZE):
+            files = [('dir/file%d.mkv' % i, rng.randint(1, 1 << 30)) for i in xrange(rng.randint(1, 5))]
+            batch.append({'hash': random_bytes(rng, 20).encode('hex'), 'name': 'torrent %d' % rng.getrandbits(32),
+                          'size': str(sum(length for _, length in files)), 'file_count': len(files),
+                          'piece_length': 1 << 20, 'files': files})
+        batches.append(batch)
+    batches.reverse()
+
+    def record_batch():
+        rows, file_rows = [], []
+        now = int(time())
+        for metadata in batches.pop():
+            infohash = sqlite3.Binary(metadata['hash'].decode('hex'))
+            rows.append((infohash, decode_name(metadata['name']), int(metadata['size']), metadata['file_count'],
+                         metadata['piece_length'], now, now))
+            for path, length in metadata['files']:
+                file_rows.append((infohash, decode_name(path), length))
+        flush_records(sqlite_util, rows, file_rows)
+
+    return record_batch
+
+
+# (名称, 构造被测函数, 每轮调用次数)
+BENCHMARKS = [
+    ('bencode_krpc', bench_bencode, 2000),
+    ('bdecode_krpc', bench_bdecode, 2000),
+    ('decode_nodes', bench_decode_nodes, 20000),
+    ('encode_nodes', bench_encode_nodes, 5000),
+    ('bloomfilter_add', bench_bloomfilter_add, 20),
+    ('mmh3_hash', bench_mmh3_hash, 50),
+    ('mmh3_hash128', bench_mmh3_hash128, 20),
+    ('parse_metadata', bench_parse_metadata, 200),
+    ('decodeh_decode', bench_decodeh, 100),
+    ('recorder_insert', bench_recorder, 1),
+]
+
+
+def run_benchmark(build, loops, runs):
+    """
+    每个基准使用同一随机种子生成输入，先预热一轮，再计时runs轮，每轮调用loops次
+    计时期间关闭gc（timeit的默认行为），返回每轮中单次调用的耗时(秒)
+    """
+    func = build(random.Random(SEED), loops * (runs + 1))
+    timer = timeit.Timer(func)
+    timer.timeit(loops)
+    return [timer.timeit(loops) / loops for _ in xrange(runs)]
+
+
+def summarize(values):
+    mean = sum(values) / len(values)
+    stdev = math.sqrt(sum((value - mean) ** 2 for value in values) / (len(values) - 1)) if len(values) > 1 else 0.0
+    return {'mean': mean, 'stdev': stdev, 'min': min(values), 'values': values}
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """返回 [(名称, 当前/基线的比值, 是否回退)]，基线中没有的基准不参与对比"""
+    comparisons = []
+    for name, result in sorted(results['benchmarks'].iteritems()):
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            continue
+        ratio = result['mean'] / base['mean']
+        noise = 2 * (result['stdev'] + base['stdev'])
+        regressed = ratio > 1 + threshold and result['mean'] - base['mean'] > noise
+        comparisons.append((name, ratio, regressed))
+    return comparisons
+
+
+def format_time(seconds):
+    for unit, scale in (('ns', 1e9), ('us', 1e6), ('ms', 1e3)):
+        if seconds * scale < 1000:
+            return '%.1f %s' % (seconds * scale, unit)
+    return '%.2f s' % seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='micro-benchmarks for the protocol hot paths')
+    parser.add_argument('names', nargs='*', help='only run these benchmarks')
+    parser.add_argument('-o', '--output', help='write results as JSON')
+    parser.add_argument('--baseline', help='compare against a previously saved result')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS)
+    args = parser.parse_args()
+
+    unknown = set(args.names) - set(name for name, _, _ in BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmark: %s' % ', '.join(sorted(unknown)))
+
+    results = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'sqlite': sqlite3.sqlite_version,
+        'seed': SEED,
+        'runs': args.runs,
+        'timestamp': int(time()),
+        'benchmarks': {},
+    }
+    TEMP_DIR = tempfile.mkdtemp(prefix='benchmark')
+    try:
+        for name, build, loops in BENCHMARKS:
+            if args.names and name not in args.names:
+                continue
+            result = summarize(run_benchmark(build, loops, args.runs))
+            result['loops'] = loops
+            results['benchmarks'][name] = result
+            print('%-18s %10s +- %-10s (min %s)' % (name, format_time(result['mean']), format_time(result['stdev']),
+                                                   format_time(result['min'])))
+    finally:
+        shutil.rmtree(TEMP_DIR, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('python') != results['python'] or baseline.get('platform') != results['platform']:
+            sys.stderr.write('warning: baseline was recorded on %s / Python %s\n' %
+                             (baseline.get('platform'), baseline.get('python')))
+        regressions = 0
+        for name, ratio, regressed in compare(results, baseline, args.threshold):
+            print('%-18s %5.2fx %s' % (name, ratio, 'REGRESSION' if regressed else
+                                       'faster' if ratio < 1 - args.threshold else 'same'))
+            regressions += regressed
+        sys.exit(1 if regressions else 0)
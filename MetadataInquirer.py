@@ -1,24 +1,38 @@
 # encoding: utf-8
 # 实现bep_0009获取元数据扩展协议
+import errno
 import gc
 import hashlib
-import math
+import os
 import random
-import re
+import select
 import socket
-from struct import pack
+import types
+from Queue import Queue, Empty, Full
+from collections import OrderedDict
+from struct import pack, unpack
+from threading import Thread, Lock
 from time import sleep, time
 
-from libs.bencode import bencode
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from libs.bencode import bencode, decode_dict
+from libs.infodict import parse_info
 
 BT_PROTOCOL = 'BitTorrent protocol'
 
-def send_handshake(the_socket, infohash):
+# 握手与扩展握手报文的构造由线程模式与事件循环模式共用，两种模式只是发送方式不同
+def pack_handshake(infohash):
     bt_header = chr(len(BT_PROTOCOL)) + BT_PROTOCOL
     ext_bytes = '\x00\x00\x00\x00\x00\x10\x00\x01'
     peer_id = '-LT0100-' + hashlib.sha1(''.join(chr(random.randint(0, 255)) for _ in xrange(20))).digest()[:12]
-    packet = bt_header + ext_bytes + infohash + peer_id
-    the_socket.send(packet)
+    return bt_header + ext_bytes + infohash + peer_id
+
+def send_handshake(the_socket, infohash):
+    the_socket.sendall(pack_handshake(infohash))
 
 def check_handshake(packet, self_infohash):
     try:
@@ -39,125 +53,726 @@ def check_handshake(packet, self_infohash):
 
     return True
 
+def supports_extension(packet):
+    """对方握手的保留字节中是否声明支持 bep_0010 扩展协议"""
+    return len(packet) > 25 and bool(ord(packet[25]) & 0x10)
+
 
 
 # 握手确定 bep_0009 获取元数据扩展协议
 BT_MSG_ID = 20
 EXT_HANDSHAKE_ID = 0
+UT_METADATA_ID = 1  # 扩展握手中声明的本地 ut_metadata id，对方按该 id 回送元数据
+UT_METADATA_MSG_PREFIX = chr(BT_MSG_ID) + chr(UT_METADATA_ID)
+METADATA_PIECE_SIZE = 16 * 1024
+EXT_HANDSHAKE_MSG_PREFIX = chr(BT_MSG_ID) + chr(EXT_HANDSHAKE_ID)
+MAX_MESSAGE_SIZE = 1 << 20  # 防止异常长度前缀导致分配过大的缓冲区
+MAX_METADATA_SIZE = 4 * 1024 * 1024  # 正常种子的元数据远小于此，更大的metadata_size视为伪造
+HANDSHAKE_LEN = 1 + len(BT_PROTOCOL) + 8 + 20 + 20
+
+def pack_message(msg):
+    return pack('>I', len(msg)) + msg
 
 def send_message(the_socket, msg):
-    msg_len = pack('>I', len(msg))
-    the_socket.send(msg_len + msg)
+    the_socket.sendall(pack_message(msg))
+
+def pack_ext_handshake():
+    return pack_message(chr(BT_MSG_ID) + chr(EXT_HANDSHAKE_ID) + bencode({'m': {'ut_metadata': UT_METADATA_ID}}))
 
 def send_ext_handshake(the_socket):
-    msg = chr(BT_MSG_ID) + chr(EXT_HANDSHAKE_ID) + bencode({'m': {'ut_metadata': 1}})
-    send_message(the_socket, msg)
+    the_socket.sendall(pack_ext_handshake())
+
+def pack_metadata_requests(ut_metadata, piece_count):
+    """一次性拼好所有 piece 的请求消息，流水线发送"""
+    packets = []
+    for piece in xrange(piece_count):
+        packets.append(pack_message(chr(BT_MSG_ID) + chr(ut_metadata) + bencode({'msg_type': 0, 'piece': piece})))
+    return ''.join(packets)
+
+def parse_ext_handshake(msg):
+    """
+    msg 为去掉长度前缀的扩展握手消息：消息id + 扩展id(0) + B编码字典，返回 (ut_metadata, metadata_size)
+    ut_metadata 为对方声明的扩展id(1~255)，对方不支持时抛出 NoExtension
+    对方还没有该种子的元数据时不给出metadata_size（如libtorrent），这只与当前种子有关，抛出 InquiryError 而不是 NoExtension
+    metadata_size 在分配缓冲区、生成请求之前检查，超过 MAX_METADATA_SIZE 的直接拒绝
+    """
+    try:
+        handshake, _ = decode_dict(msg, 2)
+    except (IndexError, KeyError, ValueError):
+        raise InquiryError('invalid extended handshake')
+    extensions = handshake.get('m')
+    ut_metadata = extensions.get('ut_metadata') if isinstance(extensions, dict) else None
+    if not isinstance(ut_metadata, (int, long)) or not 0 < ut_metadata < 256:
+        raise NoExtension('ut_metadata not supported')
+    metadata_size = handshake.get('metadata_size')
+    if not isinstance(metadata_size, (int, long)):
+        raise InquiryError('metadata_size not given')
+    if not 0 < metadata_size <= MAX_METADATA_SIZE:
+        raise InquiryError('invalid metadata_size: %d' % metadata_size)
+    return ut_metadata, metadata_size
 
-def request_metadata(the_socket, ut_metadata, piece):
-    msg = chr(BT_MSG_ID) + chr(ut_metadata) + bencode({'msg_type': 0, 'piece': piece})
-    send_message(the_socket, msg)
+def recv_exactly(the_socket, buf):
+    """用 recv_into 填满预先分配的 buf，对端提前关闭连接时抛出异常"""
+    view = memoryview(buf)
+    while view:
+        n = the_socket.recv_into(view)
+        if n == 0:
+            raise socket.error(errno.ECONNRESET, 'connection closed by peer')
+        view = view[n:]
+    return buf
 
-def get_ut_metadata(data):
-    ut_metadata = 'ut_metadata'
-    index = data.index(ut_metadata) + len(ut_metadata) + 1
-    return int(data[index])
 
-def get_metadata_size(data):
-    metadata_size = 'metadata_size'
-    start = data.index(metadata_size) + len(metadata_size) + 1
-    data = data[start:]
-    return int(data[:data.index('e')])
+def recv_message(the_socket):
+    """读取一条完整的 BT 消息：4字节长度前缀 + 消息体，返回消息体"""
+    length = unpack('>I', str(recv_exactly(the_socket, bytearray(4))))[0]
+    if length > MAX_MESSAGE_SIZE:
+        raise ValueError('message too large: %d' % length)
+    return str(recv_exactly(the_socket, bytearray(length)))
+
+
+def recv_ext_handshake(the_socket):
+    """跳过扩展握手之前的 bitfield、have 等消息，读到对方的扩展握手后返回"""
+    while True:
+        msg = recv_message(the_socket)
+        if msg[:2] == EXT_HANDSHAKE_MSG_PREFIX:
+            return msg
 
-def recv_all(the_socket, timeout=15):
-    the_socket.setblocking(0)
-    total_data = []
-    begin = time()
 
+def recv_metadata_piece(the_socket):
+    """跳过 bitfield、have 等其他消息，读到一条 ut_metadata 数据消息后立即返回"""
     while True:
-        sleep(0.05)
-        if total_data and time() - begin > timeout:
-            break
-        elif time() - begin > timeout * 2:
-            break
+        msg = recv_message(the_socket)
+        if msg[:2] == UT_METADATA_MSG_PREFIX:
+            return msg
+
+
+class MetadataPieces(object):
+    """
+    按 piece 序号拼装元数据，乱序到达也能正确组装；缓冲区随连续到达的前缀增长，不按声明的 metadata_size 预先分配
+    连续到达的前缀部分即时送入 sha1，全部到齐后与 infohash 校验，拒绝损坏或伪造的元数据
+    """
+
+    def __init__(self, metadata_size):
+        self.metadata_size = metadata_size
+        self.piece_count = (metadata_size + METADATA_PIECE_SIZE - 1) // METADATA_PIECE_SIZE
+        self.data = bytearray()
+        self.out_of_order = {}  # 前缀之后提前到达的 piece
+        self.sha1 = hashlib.sha1()
+        self.hashed_count = 0
+
+    def piece_length(self, piece):
+        return min(METADATA_PIECE_SIZE, self.metadata_size - piece * METADATA_PIECE_SIZE)
+
+    def feed(self, msg):
+        """msg 为去掉长度前缀的 ut_metadata 消息：消息id + 扩展id + B编码字典 + piece数据"""
         try:
-            data = the_socket.recv(1024)
-            if data:
-                total_data.append(data)
-                begin = time()
-        except:
-            pass
-    return ''.join(total_data)
+            header, start = decode_dict(msg, 2)
+        except (IndexError, KeyError, ValueError):
+            raise ValueError('invalid metadata piece header')
+        if header.get('msg_type') != 1:  # 1为data，2为reject
+            raise ValueError('metadata piece rejected')
+        piece = header.get('piece')
+        if not isinstance(piece, (int, long)) or not 0 <= piece < self.piece_count:
+            raise ValueError('invalid metadata piece index')
+        if len(msg) - start != self.piece_length(piece):
+            raise ValueError('invalid metadata piece length')
+        if piece < self.hashed_count or piece in self.out_of_order:
+            return
+        self.out_of_order[piece] = msg[start:]
 
+        while self.hashed_count in self.out_of_order:
+            chunk = self.out_of_order.pop(self.hashed_count)
+            self.data += chunk
+            self.sha1.update(chunk)
+            self.hashed_count += 1
 
+    def is_complete(self):
+        return self.hashed_count == self.piece_count
 
-def inquire(infohash, address, metadata_queue, timeout=15):
+    def verify(self, infohash):
+        return self.is_complete() and self.sha1.digest() == infohash
+
+
+def parse_metadata(infohash, metadata):
     """
     数据字典格式：
     {
       "hash": "9B4E6D5134988706C004F9B245A5B214E3EF1941",
       "name": "种子名称",
-      "size": "18679173"
+      "size": "18679173",
+      "file_count": 2,
+      "piece_length": 262144,
+      "files": [("目录/文件名", 18678149), ("目录/说明.txt", 1024)]
     }
     """
-    info = {}
+    # 流式解析info字典，只取需要的字段，截断或畸形的数据也能取出已解析的部分
+    parsed = parse_info(metadata)
+    info = {
+        'hash': infohash.encode('hex'),
+        'name': parsed['name'] or '',
+        'size': str(parsed['size']),
+        'file_count': parsed['file_count'],
+        'piece_length': parsed['piece_length'],
+        'files': parsed['files'],
+    }
+
+    # 只记录有效元数据
+    if info['size'] != '0' and info['name'] != '':
+        return info
+    return None
+
+
+# 获取失败的分类，用于按peer退避
+REFUSED = 'refused'
+TIMEOUT = 'timeout'
+NO_EXTENSION = 'no_extension'
+BAD_HANDSHAKE = 'bad_handshake'
+ERROR = 'error'
+LOCAL = 'local'  # 本机资源不足（文件描述符、缓冲区、本地端口耗尽），与peer无关，不计入退避，稍后重试同一peer
+
+LOCAL_ERRNOS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.EADDRNOTAVAIL)
+LOCAL_RETRIES = 5
+LOCAL_RETRY_INTERVAL = 1
+
+
+class InquiryError(Exception):
+    outcome = ERROR
+
+
+class BadHandshake(InquiryError):
+    outcome = BAD_HANDSHAKE
+
+
+class NoExtension(InquiryError):
+    outcome = NO_EXTENSION
+
+
+def classify_failure(e):
+    if isinstance(e, socket.timeout):
+        return TIMEOUT
+    if isinstance(e, InquiryError):
+        return e.outcome
+    if isinstance(e, EnvironmentError) and e.args and e.args[0] in LOCAL_ERRNOS:
+        return LOCAL
+    if isinstance(e, socket.error) and e.args:
+        if e.args[0] == errno.ETIMEDOUT:
+            return TIMEOUT
+        if e.args[0] in (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH):
+            return REFUSED
+    return ERROR
+
+
+class PeerFailureCache(object):
+    """
+    按 (ip, port) 记录最近一次获取失败的类型，退避期内跳过该peer，连续失败时退避时间按2的幂增长
+    超过capacity时淘汰最久未更新的记录（LRU）；退避期结束后再过同样长的时间没有新的失败则遗忘
+    stats() 给出跳过次数（命中）和估计节省的时间（被跳过的peer上次失败所花时间之和）
+    """
+    BACKOFF = {REFUSED: 10 * 60, TIMEOUT: 5 * 60, NO_EXTENSION: 6 * 60 * 60, BAD_HANDSHAKE: 60 * 60, ERROR: 2 * 60}
+
+    def __init__(self, capacity=50000, max_backoff=24 * 60 * 60):
+        self.capacity = capacity
+        self.max_backoff = max_backoff
+        self.entries = OrderedDict()  # (ip, port) -> [失败类型, 连续失败次数, 退避截止时间, 退避时长, 上次失败耗时]
+        self.hits = 0
+        self.misses = 0
+        self.saved_time = 0.0
+        self.hits_by_outcome = dict.fromkeys(self.BACKOFF, 0)
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def is_blocked(self, address):
+        now = time()
+        with self.lock:
+            entry = self.entries.get(address)
+            if entry is not None:
+                outcome, _, until, backoff, cost = entry
+                if now < until:
+                    self.hits += 1
+                    self.hits_by_outcome[outcome] += 1
+                    self.saved_time += cost
+                    return True
+                if now > until + backoff:
+                    del self.entries[address]
+            self.misses += 1
+            return False
+
+    def filter(self, addresses):
+        """去掉退避期内的peer"""
+        return [address for address in addresses if not self.is_blocked(address)]
+
+    def record_failure(self, address, outcome, cost):
+        now = time()
+        with self.lock:
+            entry = self.entries.pop(address, None)
+            failures = 1 if entry is None else entry[1] + 1
+            backoff = min(self.BACKOFF[outcome] << (failures - 1), self.max_backoff)
+            self.entries[address] = [outcome, failures, now + backoff, backoff, cost]
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def record_success(self, address):
+        with self.lock:
+            self.entries.pop(address, None)
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'saved_time': self.saved_time, 'hits_by_outcome': dict(self.hits_by_outcome)}
+
+
+# 进程内共享，线程模式与事件循环模式都在这里记录各peer的获取结果
+peer_failures = PeerFailureCache()
+
+
+def inquire(infohash, address, metadata_queue, timeout=15):
+    """
+    线程模式：阻塞 socket 获取元数据，每个请求占用一个线程，返回是否从该peer取得了校验通过的元数据
+    本机资源不足的错误（见 LOCAL_ERRNOS）不记为peer的失败，直接抛出由调用方重试
+    """
     the_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    begin = time()
     try:
         the_socket.settimeout(timeout)
         the_socket.connect(address)
 
         # handshake
         send_handshake(the_socket, infohash)
-        packet = the_socket.recv(4096)
+        packet = str(recv_exactly(the_socket, bytearray(HANDSHAKE_LEN)))  # 只读握手本身，其后的消息留给按长度分帧读取
         if not check_handshake(packet, infohash):
-            return
+            raise BadHandshake()
+        if not supports_extension(packet):
+            raise NoExtension()
 
         # ext handshake
         send_ext_handshake(the_socket)
-        packet = the_socket.recv(4096)
-        ut_metadata, metadata_size = get_ut_metadata(packet), get_metadata_size(packet)
-        # request each piece of metadata
-        metadata = []
-        for piece in xrange(int(math.ceil(metadata_size / (16.0 * 1024)))):  # piece是个控制块，根据控制块下载数据
-            request_metadata(the_socket, ut_metadata, piece)
-            packet = recv_all(the_socket, timeout)
-            metadata.append(packet[packet.index('ee') + 2:])
-        metadata = ''.join(metadata)
-
-        # 拼装数据
-        info['hash'] = infohash.encode('hex')
-
-        # 用bdecode解码可能获取不到数据，直接用正则获取
-        info['name'] = ''
-        match_obj = re.search(r':name\.utf-8(\d*?):', metadata, re.M | re.I)
-        if match_obj:
-            s0 = match_obj.group(0)
-            s1 = match_obj.group(1)
-            info['name'] = metadata[metadata.index(s0) + len(s0):metadata.index(s0) + len(s0) + int(s1)]
-        else:
-            match_obj = re.search(r':name(\d*?):', metadata, re.M | re.I)
-            if match_obj:
-                s0 = match_obj.group(0)
-                s1 = match_obj.group(1)
-                info['name'] = metadata[metadata.index(s0) + len(s0):metadata.index(s0) + len(s0) + int(s1)]
-
-        info['size'] = 0
-        for s in re.findall(r':lengthi(\d*?)e', metadata, re.M | re.I):
-            info['size'] += int(s)
-        info['size'] = str(info['size'])
-
-        # 只记录有效元数据
-        if info['size'] != '0' and info['name'] != '':
+        ut_metadata, metadata_size = parse_ext_handshake(recv_ext_handshake(the_socket))
+        # 一次请求所有piece，按piece序号组装
+        pieces = MetadataPieces(metadata_size)
+        the_socket.sendall(pack_metadata_requests(ut_metadata, pieces.piece_count))
+        while not pieces.is_complete():
+            pieces.feed(recv_metadata_piece(the_socket))
+        if not pieces.verify(infohash):
+            raise ValueError('metadata hash mismatch')
+        metadata = str(pieces.data)
+        del pieces
+
+        info = parse_metadata(infohash, metadata)
+        if info is not None:
             metadata_queue.put(info)
         del metadata
         gc.collect()
-    except:
+        peer_failures.record_success(address)
+        return True
+    except Exception as e:
         # import traceback
         # traceback.print_exc()
-        pass
+        outcome = classify_failure(e)
+        if outcome == LOCAL:
+            raise
+        peer_failures.record_failure(address, outcome, time() - begin)
+        return False
     finally:
         the_socket.close()  # 确保关闭socket
 
 
+def inquire_peers(infohash, addresses, metadata_queue, timeout=15):
+    """依次尝试announce过同一infohash的各个peer，直到某个peer成功；本机资源不足时等待后重试同一peer"""
+    for address in addresses:
+        for retry in xrange(LOCAL_RETRIES + 1):
+            try:
+                if inquire(infohash, address, metadata_queue, timeout):
+                    return True
+                break
+            except EnvironmentError as e:
+                if classify_failure(e) != LOCAL:
+                    raise
+                sleep(LOCAL_RETRY_INTERVAL)
+    return False
+
+
+# 事件循环模式：单线程在非阻塞 socket 上同时驱动大量 bep_0009 会话
+# 协程以生成器实现，yield (socket, 事件) 表示等待该 socket 可读/可写，yield 生成器表示调用子协程，
+# yield PARK 表示暂停到事件循环的下一轮再继续（如元数据队列已满）
+READ = 'r'
+WRITE = 'w'
+PARK = None
+
+IN_PROGRESS_ERRNOS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, getattr(errno, 'WSAEWOULDBLOCK', -1))
+RETRY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, getattr(errno, 'WSAEWOULDBLOCK', -1))
+
+
+def pop_message(buf):
+    """从接收缓冲区中取出一条完整的 BT 消息(4字节长度前缀 + 消息体)，数据不完整时返回None"""
+    if len(buf) < 4:
+        return None
+    length = unpack('>I', str(buf[:4]))[0]
+    if length > MAX_MESSAGE_SIZE:
+        raise ValueError('message too large: %d' % length)
+    if len(buf) < 4 + length:
+        return None
+    msg = str(buf[4:4 + length])
+    del buf[:4 + length]
+    return msg
+
+
+def async_connect(the_socket, address):
+    err = the_socket.connect_ex(address)
+    if err != 0 and err not in IN_PROGRESS_ERRNOS:
+        raise socket.error(err, os.strerror(err))
+    yield the_socket, WRITE
+    err = the_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err != 0:
+        raise socket.error(err, os.strerror(err))
+
+
+def async_send(the_socket, data):
+    while data:
+        yield the_socket, WRITE
+        try:
+            data = data[the_socket.send(data):]
+        except socket.error as e:
+            if e.args[0] not in RETRY_ERRNOS:
+                raise
+
+
+def async_recv(the_socket, buf):
+    """至少读取一次数据追加到buf"""
+    while True:
+        yield the_socket, READ
+        try:
+            data = the_socket.recv(16384)
+        except socket.error as e:
+            if e.args[0] in RETRY_ERRNOS:
+                continue
+            raise
+        if not data:
+            raise socket.error(errno.ECONNRESET, 'connection closed by peer')
+        buf.extend(data)
+        return
+
+
+def async_put(queue, item):
+    """队列满时暂停到下一轮重试，不能在事件循环线程上阻塞等待recorder"""
+    while True:
+        try:
+            queue.put(item, False)
+            return
+        except Full:
+            yield PARK
+
+
+def inquire_async(infohash, address, metadata_queue, budget=None):
+    """
+    事件循环模式的 inquire，由 MetadataFetchLoop 驱动；单次等待的超时由事件循环按 submit 的 timeout 处理
+    budget 为事件循环共享的 MetadataBudget，请求piece之前按 metadata_size 占用，配额不足时暂停等待
+    生成器无法返回值，正常结束表示成功，失败时抛出异常
+    """
+    the_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    the_socket.setblocking(0)
+    buf = bytearray()
+    reserved = 0
+    try:
+        yield async_connect(the_socket, address)
+
+        # handshake
+        yield async_send(the_socket, pack_handshake(infohash))
+        while len(buf) < HANDSHAKE_LEN:
+            yield async_recv(the_socket, buf)
+        if not check_handshake(str(buf[:HANDSHAKE_LEN]), infohash):
+            raise BadHandshake()
+        if not supports_extension(str(buf[:HANDSHAKE_LEN])):
+            raise NoExtension()
+        del buf[:HANDSHAKE_LEN]
+
+        # ext handshake
+        yield async_send(the_socket, pack_ext_handshake())
+        while True:
+            msg = pop_message(buf)
+            if msg is None:
+                yield async_recv(the_socket, buf)
+            elif msg[:2] == EXT_HANDSHAKE_MSG_PREFIX:
+                break
+        ut_metadata, metadata_size = parse_ext_handshake(msg)
+        if budget is not None:
+            while not budget.acquire(metadata_size):
+                yield PARK
+            reserved = metadata_size
+
+        # 一次请求所有piece，按piece序号组装
+        pieces = MetadataPieces(metadata_size)
+        yield async_send(the_socket, pack_metadata_requests(ut_metadata, pieces.piece_count))
+        while not pieces.is_complete():
+            msg = pop_message(buf)
+            if msg is None:
+                yield async_recv(the_socket, buf)
+            elif msg[:2] == UT_METADATA_MSG_PREFIX:
+                pieces.feed(msg)
+        if not pieces.verify(infohash):
+            raise ValueError('metadata hash mismatch')
+
+        info = parse_metadata(infohash, str(pieces.data))
+    finally:
+        the_socket.close()
+        if reserved:
+            budget.release(reserved)
+    if info is not None:
+        yield async_put(metadata_queue, info)
+
+
+def inquire_peers_async(infohash, addresses, metadata_queue, budget=None):
+    """
+    事件循环模式的 inquire_peers，在同一个任务中依次尝试各个peer
+    本机资源不足时暂停任务（不占用socket，仍计入并发数），LOCAL_RETRY_INTERVAL 后重试同一peer
+    """
+    for address in addresses:
+        for retry in xrange(LOCAL_RETRIES + 1):
+            begin = time()
+            try:
+                yield inquire_async(infohash, address, metadata_queue, budget)
+            except Exception as e:
+                outcome = classify_failure(e)
+                if outcome != LOCAL:
+                    peer_failures.record_failure(address, outcome, time() - begin)
+                    break
+                resume_at = time() + LOCAL_RETRY_INTERVAL
+                while time() < resume_at:
+                    yield PARK
+                continue
+            peer_failures.record_success(address)
+            return
+
+
+class Poller(object):
+    """Linux 下使用 epoll 避开 select 的 FD_SETSIZE(1024) 限制，其他平台退回 select"""
+
+    def __init__(self):
+        self.events = {}
+        self.epoll = None
+        if hasattr(select, 'epoll'):
+            self.epoll = select.epoll()
+            self.epoll_masks = {READ: select.EPOLLIN, WRITE: select.EPOLLOUT}
+
+    def wait(self, fd, event):
+        if self.epoll is not None:
+            if fd not in self.events:
+                self.epoll.register(fd, self.epoll_masks[event])
+            elif self.events[fd] != event:
+                self.epoll.modify(fd, self.epoll_masks[event])
+        self.events[fd] = event
+
+    def remove(self, fd):
+        if self.events.pop(fd, None) is not None and self.epoll is not None:
+            try:
+                self.epoll.unregister(fd)
+            except (IOError, OSError, ValueError):
+                pass  # socket关闭时fd已被epoll自动移除
+
+    def poll(self, timeout):
+        if self.epoll is not None:
+            return [fd for fd, _ in self.epoll.poll(timeout)]
+        readers = [fd for fd, event in self.events.iteritems() if event == READ]
+        writers = [fd for fd, event in self.events.iteritems() if event == WRITE]
+        if not readers and not writers:
+            sleep(timeout)
+            return []
+        r, w, x = select.select(readers, writers, writers, timeout)  # Windows下连接失败通过异常集合通知
+        return r + w + x
+
+
+PARK_INTERVAL = 0.1  # 只有暂停的任务时每轮的间隔
+MAX_BUFFERED_METADATA = 256 * 1024 * 1024  # 事件循环中所有会话的元数据缓冲区总量上限
+FD_RESERVE = 256  # 为DHT的UDP socket、数据库连接、线程方式的获取等保留的文件描述符
+
+
+def fd_limited_concurrency(wanted):
+    """
+    每个会话占用一个文件描述符，尽量把 RLIMIT_NOFILE 的软限制提高到 wanted 加保留数（不超过硬限制）
+    提高不了时把并发数限制在软限制减去保留数之内，避免 socket() 因 EMFILE 失败
+    """
+    if resource is None:
+        return wanted
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return wanted
+    needed = wanted + FD_RESERVE
+    if soft < needed:
+        new_soft = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+            soft = new_soft
+        except (ValueError, OSError):
+            pass
+    reserve = min(FD_RESERVE, soft // 2)
+    return max(1, min(wanted, soft - reserve))
+
+
+class MetadataBudget(object):
+    """
+    事件循环中各会话共享的元数据缓冲区配额，按声明的 metadata_size 占用，会话结束时归还
+    防止大量会话各自声明接近 MAX_METADATA_SIZE 的元数据耗尽内存；只在事件循环线程中使用，不需要加锁
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.used = 0
+
+    def acquire(self, size):
+        # 配额全部空闲时总是允许，单个会话不会因 capacity 过小而永远等待
+        if self.used and self.used + size > self.capacity:
+            return False
+        self.used += size
+        return True
+
+    def release(self, size):
+        self.used -= size
+
+
+class FetchTask(object):
+    __slots__ = ['stack', 'socket', 'fd', 'deadline', 'timeout']
+
+    def __init__(self, coroutine, timeout):
+        self.stack = [coroutine]
+        self.socket = None
+        self.fd = None
+        self.deadline = time() + timeout
+        self.timeout = timeout
+
+
+class MetadataFetchLoop(Thread):
+    """
+    进程内共享的元数据获取事件循环，代替每个 announce 一个线程的方式
+    max_concurrency 为同时进行的会话上限（包括已取得元数据、等待写入队列的会话），待处理请求超过上限时 submit 阻塞，起到反压作用
+    max_concurrency 超出进程可用的文件描述符时会被调低，见 fd_limited_concurrency
+    max_metadata_bytes 为所有会话元数据缓冲区的总量上限，超出时新会话在请求piece之前暂停等待
+    """
+
+    def __init__(self, max_concurrency=2000, max_metadata_bytes=MAX_BUFFERED_METADATA):
+        Thread.__init__(self)
+        self.setDaemon(True)
+
+        self.isLoopWorking = True
+        self.max_concurrency = fd_limited_concurrency(max_concurrency)
+        self.pending_queue = Queue(maxsize=self.max_concurrency)
+        self.metadata_budget = MetadataBudget(max_metadata_bytes)
+        self.tasks = {}
+        self.parked = []  # yield PARK 暂停的任务，每轮重试一次
+        self.poller = Poller()
+
+    def submit(self, infohash, addresses, metadata_queue, timeout=15):
+        """addresses 为候选peer列表，前一个失败时在同一任务中尝试下一个；也可以只传一个 (ip, port)"""
+        if isinstance(addresses, tuple):
+            addresses = [addresses]
+        self.pending_queue.put((infohash, addresses, metadata_queue, timeout))
+
+    def stop(self):
+        self.isLoopWorking = False
+
+    def run(self):
+        while self.isLoopWorking:
+            self.spawn()
+            self.resume_parked()
+            if not self.tasks:
+                if self.parked:
+                    sleep(PARK_INTERVAL)
+                continue
+            for fd in self.poller.poll(0.1):
+                task = self.tasks.get(fd)
+                if task is not None:
+                    self.step(task)
+            self.expire()
+        for task in self.tasks.values() + self.parked:
+            self.close(task)
+
+    def spawn(self):
+        while len(self.tasks) + len(self.parked) < self.max_concurrency:
+            try:
+                if self.tasks or self.parked:
+                    infohash, addresses, metadata_queue, timeout = self.pending_queue.get_nowait()
+                else:
+                    infohash, addresses, metadata_queue, timeout = self.pending_queue.get(timeout=0.5)  # 空闲时阻塞等待
+            except Empty:
+                return
+            coroutine = inquire_peers_async(infohash, addresses, metadata_queue, self.metadata_budget)
+            self.step(FetchTask(coroutine, timeout))
+
+    def resume_parked(self):
+        parked, self.parked = self.parked, []
+        for task in parked:
+            self.step(task)
+
+    def expire(self):
+        now = time()
+        for task in [task for task in self.tasks.itervalues() if task.deadline < now]:
+            self.step(task, socket.timeout('timed out'))
+
+    def step(self, task, exc=None):
+        """推进协程直到其等待下一个 socket 事件或结束"""
+        stack = task.stack
+        while stack:
+            try:
+                if exc is not None:
+                    e, exc = exc, None
+                    request = stack[-1].throw(e)
+                else:
+                    request = stack[-1].next()
+            except StopIteration:
+                stack.pop()
+                continue
+            except Exception as e:
+                stack.pop()
+                exc = e
+                continue
+            if isinstance(request, types.GeneratorType):
+                stack.append(request)
+                continue
+            if request is PARK:
+                self.release(task)
+                self.parked.append(task)
+                return
+            the_socket, event = request
+            if the_socket is not task.socket:
+                # 换到下一个peer时旧socket已关闭，其fd可能被新socket复用，按socket对象判断
+                self.release(task)
+                task.socket = the_socket
+                task.fd = the_socket.fileno()
+                self.tasks[task.fd] = task
+            self.poller.wait(task.fd, event)
+            task.deadline = time() + task.timeout
+            return
+        # 会话结束，与 inquire 一致忽略所有异常
+        self.release(task)
+
+    def release(self, task):
+        if task.fd is not None:
+            self.poller.remove(task.fd)
+            del self.tasks[task.fd]
+            task.socket = task.fd = None
+
+    def close(self, task):
+        """停止时直接关闭协程（执行其中的finally关闭socket），不再尝试其他peer"""
+        for coroutine in reversed(task.stack):
+            coroutine.close()
+        self.release(task)
+
+
 if __name__ == '__main__':
+    # 畸形的扩展握手与piece消息头必须立即被拒绝（负数长度曾使 decode_dict 死循环，冻结整个事件循环）
+    for malformed in ['d1:a1:z-6:', 'd1:a1:z-6:e', 'd1:m-1:e', 'd']:
+        try:
+            parse_ext_handshake(EXT_HANDSHAKE_MSG_PREFIX + malformed)
+        except InquiryError:
+            pass
+        else:
+            raise AssertionError(malformed)
+        try:
+            MetadataPieces(METADATA_PIECE_SIZE).feed(UT_METADATA_MSG_PREFIX + malformed)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(malformed)
+
     # 本地uTorrent测试
     inquire(str(bytearray.fromhex('01EA65BA68C5F115B3BDF49A4CF60FC59B59BACA')), ('127.0.0.1', 6881), None, 1)
\ No newline at end of file
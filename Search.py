@@ -0,0 +1,84 @@
+# encoding: utf-8
+# 按种子名称或文件路径检索已记录的种子，结果按相关度排序
+# 用法: python Search.py 关键词 [关键词 ...] [-n 20] [--offset 0] [--db matadata.db]
+import argparse
+import locale
+import sqlite3
+import sys
+from time import time
+
+from Spider import DB_NAME, SEARCH_SUPPORTED, open_database
+
+
+def build_query(text):
+    """
+    空白分隔的每个词作为一个短语，各词之间为AND，返回 (match表达式, like模式列表)
+    trigram分词下少于3个字符的词（如两个汉字的词）无法用索引匹配，改为对候选结果做LIKE过滤
+    """
+    phrases, likes = [], []
+    for term in text.split():
+        if len(term) >= 3:
+            phrases.append('"%s"' % term.replace('"', '""'))
+        else:
+            likes.append('%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+    return ' '.join(phrases), likes
+
+
+def search_available(sqlite_util):
+    """SQLite不支持FTS5 trigram时数据库中没有search表，见Spider.ensure_schema"""
+    return SEARCH_SUPPORTED and bool(sqlite_util.execute_query(
+        'select 1 from sqlite_master where type = \'table\' and name = \'search\';', None))
+
+
+def search(sqlite_util, text, limit=20, offset=0):
+    """
+    text 为unicode，返回字典列表，字段为 hash(十六进制), name, size, file_count, announce_count, first_seen, last_seen
+    名称命中的权重是文件路径的10倍，相关度相同时按announce次数排序
+    只包含少于3个字符的词时没有可用的索引，需要扫描整个全文索引表
+    """
+    match, likes = build_query(text)
+    conditions, params = [], []
+    if match:
+        conditions.append('search match ?')
+        params.append(match)
+    for like in likes:
+        conditions.append('(search.name like ? escape \'\\\' or search.paths like ? escape \'\\\')')
+        params.extend((like, like))
+    if not conditions:
+        return []
+    order = 'bm25(search, 0.0, 10.0, 1.0), ' if match else ''
+    sql = ('select hex(m.hash) as hash, m.name, m.size, m.file_count, m.announce_count, m.first_seen, m.last_seen '
+           'from search join matadata m on m.hash = search.hash where ' + ' and '.join(conditions) +
+           ' order by ' + order + 'm.announce_count desc limit ? offset ?;')
+    params.extend((limit, offset))
+    return sqlite_util.execute_query(sql, params)
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024.0
+    return '%.1f TB' % size
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='search recorded torrents by name or file path')
+    parser.add_argument('keywords', nargs='+')
+    parser.add_argument('-n', '--limit', type=int, default=20)
+    parser.add_argument('--offset', type=int, default=0)
+    parser.add_argument('--db', default=DB_NAME)
+    args = parser.parse_args()
+
+    encoding = locale.getpreferredencoding() or 'utf8'
+    text = ' '.join(args.keywords).decode(encoding, 'replace')
+    sqlite_util = open_database(args.db)
+    if not search_available(sqlite_util):
+        sys.stderr.write('search is unavailable: requires SQLite 3.34+ with FTS5 (found %s)\n' % sqlite3.sqlite_version)
+        sys.exit(1)
+    begin = time()
+    results = search(sqlite_util, text, args.limit, args.offset)
+    for result in results:
+        line = u'%s  %10s  %s' % (result['hash'].lower(), format_size(result['size'] or 0), result['name'])
+        print(line.encode(encoding, 'replace'))
+    sys.stderr.write('%d results in %.1f ms\n' % (len(results), (time() - begin) * 1000))
@@ -2,16 +2,22 @@
 import hashlib
 import os.path
 import random
+import select
 import socket
-from Queue import Queue
-from struct import unpack, pack
-from threading import Thread
-from time import sleep
+import sqlite3
+from Queue import Empty, Full
+from threading import Thread, Lock
+from time import sleep, time
 
 import MetadataInquirer
-from libs import pymmh3, decodeh
+from libs import decodeh
 from libs.SQLiteUtil import SQLiteUtil
-from libs.bencode import bencode, bdecode
+from libs.bloomfilter import DedupFilter, KnownInfohashes
+from libs.ratelimit import TokenBucket
+from libs.bencode import bdecode_many
+from libs.boundedqueue import BoundedQueue, BLOCK, PRIORITY
+from libs.krpc import PONG, FIND_NODE_QUERY, FIND_NODE_RESPONSE, GET_PEERS_RESPONSE
+from libs.nodetable import KNode, RoutingTable, NodeFrontier
 
 
 def random_id():
@@ -22,49 +28,249 @@ def get_neighbor_id(target, end=10):
     return target[:end] + random_id()[end:]
 
 
-# node节点结构
-class KNode(object):
-    def __init__(self, nid, ip=None, port=None):
-        self.nid = nid
-        self.ip = ip
-        self.port = port
-
-    def __eq__(self, other):
-        return other.nid == self.nid
-
-    def __hash__(self):
-        return hash(self.nid)
+def udp_drops(the_socket):
+    """从 /proc/net/udp 按 socket 的 inode 读取内核丢包计数，非Linux平台返回None"""
+    try:
+        inode = str(os.fstat(the_socket.fileno()).st_ino)
+        with open('/proc/net/udp') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 9 and fields[9] == inode:
+                    return int(fields[-1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+DB_NAME = 'matadata.db'
+DEDUP_FILTER_NAME = 'inquiry.filter'
+shared_dedup_filters = {}
+shared_dedup_filters_lock = Lock()
+
+# 数据库结构版本，记录在 pragma user_version 中；版本0为旧版 matadata("hash" text,"name" text,"size" text)
+# 版本1为以下结构，版本2增加全文索引
+SCHEMA_VERSION = 2
+SCHEMA = """
+create table if not exists "matadata" (
+  "hash" blob primary key not null,
+  "name" text,
+  "size" integer,
+  "file_count" integer,
+  "piece_length" integer,
+  "first_seen" integer,
+  "last_seen" integer,
+  "announce_count" integer not null default 1
+);
+create table if not exists "files" (
+  "hash" blob not null references "matadata" ("hash"),
+  "path" text,
+  "length" integer
+);
+create unique index if not exists "files_hash_path" on "files" ("hash", "path");
+create index if not exists "matadata_size" on "matadata" ("size");
+create index if not exists "matadata_first_seen" on "matadata" ("first_seen");
+create index if not exists "matadata_last_seen" on "matadata" ("last_seen");
+create index if not exists "matadata_announce_count" on "matadata" ("announce_count");
+"""
+# 种子名称与文件路径的全文索引，trigram分词不依赖空格切词，中日韩文本也能按任意连续3个字符检索
+# 触发器在matadata插入新种子时同步写入，recorder需先写入files再写入matadata，以便一并索引文件路径
+SEARCH_SCHEMA = """
+create virtual table if not exists "search" using fts5 ("hash" unindexed, "name", "paths", tokenize = 'trigram');
+create trigger if not exists "search_insert" after insert on "matadata" begin
+  insert into "search" ("hash", "name", "paths") values (new."hash", new."name",
+    (select group_concat("path", char(10)) from "files" where "hash" = new."hash"));
+end;
+"""
+MIGRATE_BATCH_SIZE = 10000
+
+
+def sqlite_supports_search():
+    """trigram分词需要 SQLite 3.34+，且编译时启用了FTS5，不少Python 2.7链接的系统SQLite不满足"""
+    if sqlite3.sqlite_version_info < (3, 34, 0):
+        return False
+    conn = sqlite3.connect(':memory:')
+    try:
+        conn.execute('create virtual table "search" using fts5 ("name", tokenize = \'trigram\');')
+        return True
+    except sqlite3.Error:
+        return False
+    finally:
+        conn.close()
+
+
+# 不满足时数据库停留在版本1，不建全文索引；没有UPSERT(3.24+)时recorder改用update加insert or ignore
+SEARCH_SUPPORTED = sqlite_supports_search()
+UPSERT_SUPPORTED = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+
+def open_database(db_name=DB_NAME):
+    """WAL模式打开数据库，并建表或把旧版本的表迁移到当前结构"""
+    sqlite_util = SQLiteUtil(db_name, pragmas=('journal_mode=WAL', 'synchronous=NORMAL'))
+    ensure_schema(sqlite_util)
+    return sqlite_util
+
+
+def ensure_schema(sqlite_util):
+    """
+    按版本依次迁移：
+    0 -> 1 旧表先改名为 matadata_v0，建好新表后分批复制再删除；每一步都可重复执行，迁移中断后再次启动会继续完成
+    1 -> 2 建立全文索引并导入已有数据，在一个事务内完成；SQLite不支持时跳过，以后换用支持的SQLite启动时再迁移
+    """
+    version = sqlite_util.execute_query('pragma user_version;', None)[0]['user_version']
+    if version >= SCHEMA_VERSION:
+        return
+    if version < 1:
+        migrate_v1(sqlite_util)
+    if version < 2 and SEARCH_SUPPORTED:
+        sqlite_util.executescript(
+            'begin;' + SEARCH_SCHEMA +
+            'insert into "search" ("hash", "name", "paths") select "hash", "name", '
+            '(select group_concat("path", char(10)) from "files" where "files"."hash" = "matadata"."hash") '
+            'from "matadata"; pragma user_version = 2; commit;')
+
+
+def migrate_v1(sqlite_util):
+    tables = set(row['name'] for row in
+                 sqlite_util.execute_query('select name from sqlite_master where type=\'table\';', None))
+    if 'matadata' in tables and 'matadata_v0' not in tables:
+        columns = set(row['name'] for row in sqlite_util.execute_query('pragma table_info("matadata");', None))
+        if 'first_seen' not in columns:
+            sqlite_util.executescript('alter table "matadata" rename to "matadata_v0";')
+            tables.add('matadata_v0')
+    sqlite_util.executescript(SCHEMA)
+    if 'matadata_v0' in tables:
+        migrate_v0(sqlite_util)
+    sqlite_util.executescript('drop table if exists "matadata_v0"; pragma user_version = 1;')
+
+
+def migrate_v0(sqlite_util):
+    """十六进制文本hash转为20字节blob，文本size转为整数；旧数据没有记录时间，first_seen/last_seen留空"""
+    last_rowid = 0
+    while True:
+        records = sqlite_util.execute_query(
+            'select rowid, hash, name, cast(size as integer) as size from matadata_v0 '
+            'where rowid > ? order by rowid limit ?;', (last_rowid, MIGRATE_BATCH_SIZE))
+        if not records:
+            break
+        rows = []
+        for record in records:
+            last_rowid = record['rowid']
+            try:
+                infohash = str(record['hash']).decode('hex')
+            except (TypeError, ValueError):
+                continue
+            if len(infohash) == 20:
+                rows.append((sqlite3.Binary(infohash), record['name'], record['size']))
+        sqlite_util.execute_batch('insert or ignore into matadata (hash,name,size) values (?,?,?);', rows)
+
+
+def shared_dedup_filter(path=DEDUP_FILTER_NAME, db_name=DB_NAME):
+    """
+    进程内共享一个去重过滤器，数据文件新建时从数据库预加载已入库的infohash
+    同时把已入库的infohash全部载入精确集合，用于排除布隆过滤器的误判
+    预加载后关闭连接池：多进程模式下在fork之前调用，sqlite连接不能跨fork使用，子进程用到时会重新建立
+    """
+    with shared_dedup_filters_lock:
+        if path not in shared_dedup_filters:
+            known = KnownInfohashes(lookup=RecordedLookup(db_name))
+            dedup_filter = DedupFilter(path, known=known)
+            if os.path.exists(db_name):
+                sqlite_util = open_database(db_name)
+                known.load_sorted(preload_infohashes(sqlite_util, dedup_filter))
+                if dedup_filter.created:
+                    dedup_filter.flush()
+                sqlite_util.close()
+            shared_dedup_filters[path] = dedup_filter
+        return shared_dedup_filters[path]
+
+
+def preload_infohashes(sqlite_util, dedup_filter):
+    """
+    按序遍历已入库的infohash供精确集合一次载入，数据文件新建时顺带写入布隆过滤器的stored部分
+    不经过add_stored，否则每条都会再进入精确集合的新增部分，每10万条触发一次全量合并
+    """
+    for (infohash,) in sqlite_util.iter_query('select hash from matadata order by hash;', None):
+        infohash = str(infohash)
+        if dedup_filter.created:
+            dedup_filter.stored.add(infohash)
+        yield infohash
+
+
+class RecordedLookup(object):
+    """
+    精确集合中没有时回退到按主键查询数据库，多进程模式下其他进程的recorder写入的数据由此得知
+    连接池在第一次查询时打开并保留，之后直接查询；fork之后的子进程不沿用父进程的连接，重新打开
+    """
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.sqlite_util = None
+        self.pid = None
+        self.lock = Lock()
+
+    def get_sqlite_util(self):
+        with self.lock:
+            if self.sqlite_util is None or self.sqlite_util.closed or self.pid != os.getpid():
+                self.sqlite_util = open_database(self.db_name)
+                self.pid = os.getpid()
+            return self.sqlite_util
+
+    def __call__(self, infohash):
+        try:
+            return bool(self.get_sqlite_util().execute_query('select 1 from matadata where hash=?;',
+                                                             (sqlite3.Binary(infohash),)))
+        except sqlite3.Error:
+            return False
+
+
+def merge_announces(announce, other):
+    """合并同一infohash的两条announce (infohash, [peer, ...])，保留先到的peer"""
+    peers = announce[1]
+    for peer in other[1]:
+        if len(peers) >= MAX_CANDIDATE_PEERS:
+            break
+        if peer not in peers:
+            peers.append(peer)
+    return announce
+
+
+def decode_name(name):
+    try:
+        return name.decode('utf8')
+    except:
+        try:
+            return name.decode('gb18030')
+        except:
+            try:
+                return decodeh.decode(name)
+            except:
+                return None
 
-    @staticmethod
-    def decode_nodes(nodes):
-        """
-        解析node串，每个node长度为26，其中20位为nid，4位为ip，2位为port
-        数据格式: [ (node ID, ip, port),(node ID, ip, port),(node ID, ip, port).... ]
-        """
-        n = []
-        length = len(nodes)
-        if (length % 26) != 0:
-            return n
 
-        for i in xrange(0, length, 26):
-            nid = nodes[i:i + 20]
-            ip = socket.inet_ntoa(nodes[i + 20:i + 24])
-            port = unpack('!H', nodes[i + 24:i + 26])[0]
-            n.append((nid, ip, port))
+# receiver 每批最多取出的包数与socket接收缓冲区大小，不支持MSG_DONTWAIT的平台(Windows)逐个接收
+# RECEIVE_WAIT 为select等待的最长时间，即receiver响应stop的延迟
+RECEIVE_BATCH_SIZE = 64
+RECEIVE_WAIT = 1
+RECEIVE_BUFFER_SIZE = 8 * 1024 * 1024
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
 
-        return n
+# 待获取元数据的announce队列上限，超过INQUIRY_MAX_AGE秒仍未调度的announce对应的peer多半已离开，直接丢弃
+INQUIRY_QUEUE_SIZE = 10000
+INQUIRY_MAX_AGE = 60
+# 同一infohash的announce在首次出现后INQUIRY_HOLD秒内合并，记录最多MAX_CANDIDATE_PEERS个peer供获取失败时依次尝试
+INQUIRY_HOLD = 3
+MAX_CANDIDATE_PEERS = 4
+# 待写库的元数据队列上限，满时线程模式阻塞等待recorder，事件循环模式暂停该会话到下一轮重试，announce通知则直接丢弃
+METADATA_QUEUE_SIZE = 10000
 
-    @staticmethod
-    def encode_nodes(nodes):
-        """ Encode a list of (id, connect_info) pairs into a node_info """
-        n = []
-        for node in nodes:
-            n.extend([node.nid, long(''.join(['%02X' % long(i) for i in node.ip.split('.')]), 16), node.port])
-        return pack('!' + '20sIH' * len(nodes), *n)
+# recorder 攒批写入：满500条或距批次第一条超过200ms即提交
+RECORDER_BATCH_SIZE = 500
+RECORDER_BATCH_INTERVAL = 0.2
 
 
 class Spider(Thread):
-    def __init__(self, bind_ip, bind_port, max_node_size):
+    def __init__(self, bind_ip, bind_port, max_node_size, fetch_loop=None, find_node_rate=20,
+                 metadata_queue=None, reuse_port=False, dedup_filter=None, inquiry_policy=PRIORITY):
         Thread.__init__(self)
         self.setDaemon(True)
 
@@ -72,26 +278,55 @@ class Spider(Thread):
 
         self.nid = random_id()
         self.max_node_size = max_node_size
-        self.node_list = []
-        self.inquiry_info_queue = Queue()
-        self.metadata_queue = Queue()
+        self.node_frontier = NodeFrontier(max_node_size)
+        self.routing_table = RoutingTable(max_node_size)
+        # find_node 每秒发包数，按上行带宽调整，实际速率记录在 find_node_pps
+        self.find_node_pacer = TokenBucket(find_node_rate)
+        self.find_node_pps = 0.0
+        # 有界队列，announce过多时按inquiry_policy在receiver处丢弃，默认同一infohash合并候选peer、被announce次数多的先获取
+        self.inquiry_info_queue = BoundedQueue(INQUIRY_QUEUE_SIZE, inquiry_policy, key=lambda announce: announce[0],
+                                               max_age=INQUIRY_MAX_AGE, merge=merge_announces, hold=INQUIRY_HOLD)
+        # 外部传入时（如多进程模式下的multiprocessing队列）由外部负责记录，不启动recorder线程
+        self.external_recorder = metadata_queue is not None
+        self.metadata_queue = metadata_queue if self.external_recorder else BoundedQueue(METADATA_QUEUE_SIZE, BLOCK)
+        self.announce_notices_dropped = 0
+        # 进程内所有Spider共享、重启后保留的去重过滤器，已入库或近期已调度的infohash不再获取
+        self.dedup_filter = dedup_filter if dedup_filter is not None else shared_dedup_filter()
+        # 为None时使用线程模式，每个announce启动一个线程获取元数据
+        self.fetch_loop = fetch_loop
 
         self.bind_ip = bind_ip
         self.bind_port = bind_port
+        self.packed_bind_ip = socket.inet_aton(bind_ip)  # 与解析出的紧凑ip直接比较
         self.ufd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        try:
+            self.ufd.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)  # 实际大小受系统rmem_max限制
+        except socket.error:
+            pass
+        if reuse_port:  # 多个进程绑定同一端口，由内核按来源地址分流
+            self.ufd.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', 15), 1)
         self.ufd.bind((self.bind_ip, self.bind_port))
+        self.packets_handled = 0
 
     def start(self):
         Thread(target=self.join_dht).start()
         Thread(target=self.receiver).start()
         Thread(target=self.sniffer).start()
-        for _ in xrange(100):  # 防止inquiry_info_queue消费过慢
-            Thread(target=self.inquirer).start()
-        Thread(target=self.recorder).start()
+        if self.fetch_loop is None:
+            for _ in xrange(100):  # 防止inquiry_info_queue消费过慢
+                Thread(target=self.inquirer).start()
+        else:
+            Thread(target=self.inquirer).start()  # 事件循环模式下投递请求不阻塞，一个线程即可
+        self.recorder_thread = None
+        if not self.external_recorder:
+            self.recorder_thread = Thread(target=self.recorder)
+            self.recorder_thread.start()
         Thread.start(self)
 
     def stop(self):
         self.isSpiderWorking = False
+        if self.recorder_thread is not None:
+            self.recorder_thread.join()  # 等待recorder写完剩余数据
 
     # 加入DHT网络
     def join_dht(self):
@@ -102,103 +337,118 @@ class Spider(Thread):
             ('dht.transmissionbt.com', 6881)
         ]
         for _ in xrange(20):
-            if len(self.node_list) == 0:
+            if len(self.node_frontier) == 0:
                 self.send_find_node(random.choice(BOOTSTRAP_NODES), self.nid)
             if self.isSpiderWorking:
                 sleep(10)
 
-    # 获取Node信息
+    # 获取Node信息，按令牌桶匀速发送find_node
     def sniffer(self):
+        report_begin = time()
         while self.isSpiderWorking:
-            for _ in xrange(200):
-                if self.isSpiderWorking:
-                    if len(self.node_list) == 0:
-                        sleep(1)
-                    else:
-                        # 伪装成目标相邻点在查找
-                        # print('send packet')
-                        node = self.node_list.pop(0)  # 线程安全 global interpreter lock
-                        self.send_find_node((node.ip, node.port), get_neighbor_id(node.nid))
-            if self.isSpiderWorking:
-                sleep(10)
+            node = self.node_frontier.pop()
+            if node is None:
+                sleep(1)
+                continue
+            self.find_node_pacer.acquire()
+            # 伪装成目标相邻点在查找
+            # print('send packet')
+            self.send_find_node((node.ip, node.port), get_neighbor_id(node.nid))
+            if time() - report_begin > 60:
+                report_begin = time()
+                self.find_node_pps = self.find_node_pacer.achieved_rate()
+                # print('find_node pps: %.1f' % self.find_node_pps)
 
     # 接收ping, find_node, get_peers, announce_peer请求和find_node回复
+    # select等到socket可读后以非阻塞方式把内核缓冲区中已到达的包一次取出，再统一解码处理
+    # socket本身保持阻塞且不设超时：设了超时的socket上MSG_DONTWAIT也会等满超时时间，select的超时用于及时响应stop
     def receiver(self):
+        buffers = [memoryview(bytearray(65536)) for _ in xrange(RECEIVE_BATCH_SIZE if MSG_DONTWAIT else 1)]
         while self.isSpiderWorking:
+            batch = []
             try:
-                (data, address) = self.ufd.recvfrom(65536)
-                # print('receive udp packet')
-                msg = bdecode(data)
-                # print msg
-                if msg['y'] == 'r':
-                    if 'nodes' in msg['r']:
-                        self.process_find_node_response(msg)
-                elif msg['y'] == 'q':
-                    if msg['q'] == 'ping':
-                        self.send_pong(msg, address)
-                    elif msg['q'] == 'find_node':
-                        self.process_find_node_request(msg, address)
-                    elif msg['q'] == 'get_peers':
-                        self.process_get_peers_request(msg, address)
-                    elif msg['q'] == 'announce_peer':
-                        self.process_announce_peer_request(msg, address)
-            except:
-                pass
+                if not select.select([self.ufd], [], [], RECEIVE_WAIT)[0]:
+                    continue
+                for view in buffers:
+                    (size, address) = self.ufd.recvfrom_into(view, 0, MSG_DONTWAIT)
+                    batch.append((view, size, address))
+            except (socket.error, select.error):
+                pass  # 缓冲区已取空
+            # print('receive %d udp packets' % len(batch))
+            self.packets_handled += len(batch)
+            messages = bdecode_many([view[:size].tobytes() for view, size, _ in batch])
+            for msg, (_, _, address) in zip(messages, batch):
+                if msg is not None:
+                    self.dispatch(msg, address)
+
+    def dispatch(self, msg, address):
+        try:
+            # print msg
+            if msg['y'] == 'r':
+                if 'nodes' in msg['r']:
+                    self.process_find_node_response(msg)
+            elif msg['y'] == 'q':
+                self.record_node(msg, address)
+                if msg['q'] == 'ping':
+                    self.send_pong(msg, address)
+                elif msg['q'] == 'find_node':
+                    self.process_find_node_request(msg, address)
+                elif msg['q'] == 'get_peers':
+                    self.process_get_peers_request(msg, address)
+                elif msg['q'] == 'announce_peer':
+                    self.process_announce_peer_request(msg, address)
+        except:
+            pass
+
+    # 已处理的包数与内核因接收缓冲区满丢弃的包数
+    def receive_stats(self):
+        return self.packets_handled, udp_drops(self.ufd)
+
+    # 各级队列的长度、高水位与丢弃计数，外部传入的metadata_queue只统计被丢弃的announce通知
+    def queue_stats(self):
+        stats = {'inquiry': self.inquiry_info_queue.stats(),
+                 'metadata': {'announce_notices_dropped': self.announce_notices_dropped}}
+        if isinstance(self.metadata_queue, BoundedQueue):
+            stats['metadata'].update(self.metadata_queue.stats())
+        return stats
 
     # 发送本节点状态正常信息
     def send_pong(self, msg, address):
-        msg = {
-            't': msg['t'],
-            'y': 'r',
-            'r': {'id': self.nid}
-        }
-        self.ufd.sendto(bencode(msg), address)
+        self.ufd.sendto(PONG.render(t=msg['t'], id=self.nid), address)
 
     # 发送查询节点请求信息
     def send_find_node(self, address, nid, target_id=random_id()):
-        msg = {
-            't': ''.join(chr(random.randint(0, 255)) for _ in xrange(2)),
-            'y': 'q',
-            'q': 'find_node',
-            'a': {'id': nid, 'target': target_id}
-        }
-        self.ufd.sendto(bencode(msg), address)
+        t = ''.join(chr(random.randint(0, 255)) for _ in xrange(2))
+        self.ufd.sendto(FIND_NODE_QUERY.render(t=t, id=nid, target=target_id), address)
 
     # 处理查询节点请求的回复信息，用于获取新的有效节点
     def process_find_node_response(self, res):
-        if len(self.node_list) > self.max_node_size:  # 限定队列大小
-            return
         nodes = KNode.decode_nodes(res['r']['nodes'])
-        for node in nodes:
-            (nid, ip, port) = node
-            if len(nid) != 20: continue
+        for (nid, ip, port) in nodes:
             if nid == self.nid: continue  # 排除自己
-            if ip == self.bind_ip: continue
-            if port < 1 or port > 65535: continue
-            self.node_list.append(KNode(nid, ip, port))
+            if ip == self.packed_bind_ip: continue
+            if port < 1: continue
+            self.routing_table.add(nid, ip, port)
+            self.node_frontier.push(nid, ip, port)
+
+    # 记录主动发来请求的节点
+    def record_node(self, msg, address):
+        nid = msg.get('a', {}).get('id')
+        if isinstance(nid, str) and len(nid) == 20 and nid != self.nid:
+            self.routing_table.add(nid, socket.inet_aton(address[0]), address[1])
 
     # 回应find_node请求信息
     def process_find_node_request(self, req, address):
-        msg = {
-            't': req['t'],
-            'y': 'r',
-            'r': {'id': get_neighbor_id(self.nid), 'nodes': KNode.encode_nodes(self.node_list[:8])}
-        }
-        self.ufd.sendto(bencode(msg), address)
+        nodes = ''.join(self.routing_table.closest(req['a']['target']))
+        self.ufd.sendto(FIND_NODE_RESPONSE.render(t=req['t'], id=get_neighbor_id(self.nid), nodes=nodes), address)
 
     # 回应get_peer请求信息
     def process_get_peers_request(self, req, address):
         infohash = req['a']['info_hash']
-        msg = {
-            't': req['t'],
-            'y': 'r',
-            'r': {
-                'id': get_neighbor_id(infohash, 3),
-                'nodes': KNode.encode_nodes(self.node_list[:8]),
-                'token': infohash[:4]  # 自定义token，例如取infohash最后四位
-            }
-        }
-        self.ufd.sendto(bencode(msg), address)
+        nodes = ''.join(self.routing_table.closest(infohash))
+        token = infohash[:4]  # 自定义token，例如取infohash最后四位
+        self.ufd.sendto(GET_PEERS_RESPONSE.render(t=req['t'], id=get_neighbor_id(infohash, 3), nodes=nodes,
+                                                  token=token), address)
 
     # 处理声明下载peer请求信息，用于获取有效的种子信息
     def process_announce_peer_request(self, req, address):
@@ -212,90 +462,133 @@ class Spider(Thread):
                 if port < 1 or port > 65535: return
 
         # print('announce_peer:' + infohash.encode('hex') + ' ip:' + address[0])
-        self.inquiry_info_queue.put((infohash, (address[0], port)))  # 加入元数据获取信息队列
+        if not self.dedup_filter.is_stored(infohash):  # 已入库的种子不再获取
+            self.inquiry_info_queue.put((infohash, [(address[0], port)]))  # 加入元数据获取信息队列，满时按策略丢弃
+        else:
+            try:
+                self.metadata_queue.put({'hash': infohash.encode('hex'), 'announce': 1}, False)  # 只记录热度
+            except Full:
+                self.announce_notices_dropped += 1  # 不阻塞receiver
 
         self.send_pong(req, address)
 
     # 查询种子信息
     def inquirer(self):
         while self.isSpiderWorking:
-            # 只用于保证局部无重复，实际数据唯一性通过数据库唯一键保证
-            inquiry_info_bloom_filter = BloomFilter(5000, 5)
-            for _ in xrange(1000):
-                if self.isSpiderWorking:
-                    try:
-                        announce = self.inquiry_info_queue.get(timeout=0.3)
-                        if inquiry_info_bloom_filter.add(announce[0] + announce[1][0]):
-                            # threads for download metadata
-                            t = Thread(target=MetadataInquirer.inquire,
-                                       args=(announce[0], announce[1], self.metadata_queue, 7))  # 超时时间不要太长防止短时间内线程过多
-                            t.start()
-                    except:
-                        pass
+            try:
+                infohash, peers = self.inquiry_info_queue.get(timeout=0.3)
+                peers = MetadataInquirer.peer_failures.filter(peers)
+                if not peers:
+                    continue  # 候选peer都在失败退避期内，不记入去重过滤器，等待其他peer的announce
+                # 实际数据唯一性通过数据库唯一键保证
+                if self.dedup_filter.add(infohash):
+                    if self.fetch_loop is not None:
+                        self.fetch_loop.submit(infohash, peers, self.metadata_queue, 7)
+                        continue
+                    # threads for download metadata
+                    t = Thread(target=MetadataInquirer.inquire_peers,
+                               args=(infohash, peers, self.metadata_queue, 7))  # 超时时间不要太长防止短时间内线程过多
+                    t.start()
+            except:
+                pass
 
     # 记录种子信息
     def recorder(self):
-        db_name = 'matadata.db'
-        need_create_table = False
-        if not os.path.exists(db_name):
-            need_create_table = True
-        sqlite_util = SQLiteUtil(db_name)
-
-        if need_create_table:
-            sqlite_util.executescript(
-                'create table "matadata" ("hash" text primary key not null,"name"  text,"size"  text);')
-        while self.isSpiderWorking:
+        record_metadata(self.metadata_queue, lambda: self.isSpiderWorking, self.dedup_filter)
+
+
+# 记录种子信息，按条数或时间窗口攒批，一个事务写入一批；is_working返回False且队列取空后退出
+# 队列中除元数据外还有已入库种子的announce通知 {'hash': ..., 'announce': 1}，只累加announce_count并刷新last_seen
+def record_metadata(metadata_queue, is_working, dedup_filter=None, db_name=DB_NAME):
+    sqlite_util = open_database(db_name)
+    rows, file_rows, announces = [], [], {}
+    batch_begin = time()
+    while True:
+        try:
+            metadata = metadata_queue.get(timeout=RECORDER_BATCH_INTERVAL)
+            if not rows and not announces:
+                batch_begin = time()
+            if 'announce' in metadata:
+                announces[metadata['hash']] = announces.get(metadata['hash'], 0) + metadata['announce']
+            else:
+                name = decode_name(metadata['name'])
+                if name is not None:
+                    infohash = sqlite3.Binary(metadata['hash'].decode('hex'))
+                    now = int(time())
+                    rows.append((infohash, name, int(metadata['size']), metadata.get('file_count'),
+                                 metadata.get('piece_length'), now, now))
+                    for path, length in metadata.get('files', ()):
+                        path = decode_name(path)
+                        if path is not None:
+                            file_rows.append((infohash, path, length))
+        except Empty:
+            if not is_working():
+                break  # 停止后先取完队列中剩余数据
+        if (rows or announces) and (len(rows) + len(announces) >= RECORDER_BATCH_SIZE or
+                                    time() - batch_begin >= RECORDER_BATCH_INTERVAL):
+            flush_records(sqlite_util, rows, file_rows, announces, dedup_filter)
+            rows, file_rows, announces = [], [], {}
+    flush_records(sqlite_util, rows, file_rows, announces, dedup_filter)
+
+
+def record_batches(rows, file_rows, announce_rows):
+    """一批记录对应的 (sql, params_list) 列表，按执行顺序排列"""
+    if UPSERT_SUPPORTED:
+        matadata_batches = [
+            ('insert into matadata (hash,name,size,file_count,piece_length,first_seen,last_seen) '
+             'values (?,?,?,?,?,?,?) on conflict (hash) do update set '
+             'last_seen=excluded.last_seen, announce_count=announce_count+1;', rows)]
+    else:
+        # 先更新已存在的种子再插入，同一事务内与UPSERT等价（同一批内重复的hash不再累加）
+        matadata_batches = [
+            ('update matadata set last_seen=?, announce_count=announce_count+1 where hash=?;',
+             [(row[6], row[0]) for row in rows]),
+            ('insert or ignore into matadata (hash,name,size,file_count,piece_length,first_seen,last_seen) '
+             'values (?,?,?,?,?,?,?);', rows)]
+    # hash为主键，其他进程已写入的种子只刷新last_seen并累加announce_count
+    # files先于matadata写入，插入新种子时由触发器把名称和文件路径一起写入全文索引
+    return ([('insert or ignore into files (hash,path,length) values (?,?,?);', file_rows)] + matadata_batches +
+            [('update matadata set announce_count=announce_count+?, last_seen=? where hash=?;', announce_rows)])
+
+
+def flush_records(sqlite_util, rows, file_rows=(), announces=None, dedup_filter=None):
+    if not rows and not announces:
+        return
+    now = int(time())
+    announce_rows = [(count, now, sqlite3.Binary(infohash.decode('hex')))
+                     for infohash, count in (announces or {}).iteritems()]
+    stored = rows
+    try:
+        sqlite_util.execute_batches(record_batches(rows, file_rows, announce_rows))
+    except Exception:
+        # 整批已回滚，逐条重试，只丢弃出错的那一条（如超出INTEGER范围的值），不连累同批的其他种子
+        files_by_hash = {}
+        for file_row in file_rows:
+            files_by_hash.setdefault(str(file_row[0]), []).append(file_row)
+        stored = []
+        for row in rows:
             try:
-                metadata = self.metadata_queue.get(timeout=0.5)
-                name = metadata['name']
-                try:
-                    name = name.decode('utf8')
-                except:
-                    try:
-                        name = name.decode('gb18030')
-                    except:
-                        try:
-                            name = decodeh.decode(name)
-                        except:
-                            continue
-                try:
-                    sqlite_util.execute(
-                        'insert into matadata (hash,name,size)values (?,?,?);',
-                        (metadata['hash'], name, metadata['size']))
-                    # import json
-                    # print json.dumps(metadata, ensure_ascii=False).decode('utf-8')
-                except:
-                    # import traceback
-                    # traceback.print_exc()
-                    # 通过hash属性唯一键去重
-                    # print metadata['hash']
-                    pass
-            except:
-                sleep(0.5)
-
-
-# 简化版布隆过滤器
-class BloomFilter(object):
-    def __init__(self, size, hash_count):
-        self.bit_number = 0  # 初始化
-        self.size = size
-        self.hash_count = hash_count
-
-    def add(self, item):
-        for i in xrange(self.hash_count):
-            index = pymmh3.hash(item, i) % self.size
-            if not (self.bit_number >> index) & 1:  # 如果是0则是新的，返回True
-                for j in xrange(self.hash_count):
-                    index1 = pymmh3.hash(item, j) % self.size
-                    self.bit_number |= 1 << index1
-                return True
-        return False
-
+                sqlite_util.execute_batches(record_batches([row], files_by_hash.get(str(row[0]), []), []))
+                stored.append(row)
+            except Exception:
+                pass
+        for announce_row in announce_rows:
+            try:
+                sqlite_util.execute_batches(record_batches([], [], [announce_row]))
+            except Exception:
+                pass
+    if dedup_filter is not None:
+        for row in stored:
+            dedup_filter.add_stored(str(row[0]))
 
 if __name__ == '__main__':
+    # 进程内所有Spider共享一个元数据获取事件循环，设为None则退回每个请求一个线程的模式
+    fetch_loop = MetadataInquirer.MetadataFetchLoop(max_concurrency=2000)
+    fetch_loop.start()
+
     spiderList = []
     for i in xrange(10):
-        spider = Spider('0.0.0.0', 8087 + i, max_node_size=1500)  # 需保证有公网ip且相应端口入方向通畅
+        spider = Spider('0.0.0.0', 8087 + i, max_node_size=1500, fetch_loop=fetch_loop)  # 需保证有公网ip且相应端口入方向通畅
         spider.start()
         spiderList.append(spider)
         sleep(1)
@@ -305,3 +598,5 @@ if __name__ == '__main__':
     for spider in spiderList:
         spider.stop()
         spider.join()
+    fetch_loop.stop()
+    fetch_loop.join()
@@ -0,0 +1,105 @@
+# encoding: utf-8
+# 多进程模式：每个worker进程运行一个独立nid的Spider，通过SO_REUSEPORT共享同一端口，
+# 元数据经multiprocessing队列汇总到单独的recorder进程写库，supervisor负责重启崩溃的worker
+import multiprocessing
+import signal
+from time import sleep, time
+
+import MetadataInquirer
+from Spider import METADATA_QUEUE_SIZE, Spider, record_metadata, shared_dedup_filter
+
+
+def reset_signals():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # 由supervisor统一处理退出
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)  # 不继承supervisor的处理函数，保证terminate有效
+
+
+def run_worker(bind_ip, bind_port, max_node_size, reuse_port, metadata_queue, stop_flag):
+    reset_signals()
+    fetch_loop = MetadataInquirer.MetadataFetchLoop(max_concurrency=2000)
+    fetch_loop.start()
+    spider = Spider(bind_ip, bind_port, max_node_size, fetch_loop=fetch_loop,
+                    metadata_queue=metadata_queue, reuse_port=reuse_port)
+    spider.start()
+    while not stop_flag.value:
+        sleep(1)
+    spider.stop()
+    fetch_loop.stop()
+
+
+def run_recorder(metadata_queue, stop_flag):
+    reset_signals()
+    record_metadata(metadata_queue, lambda: not stop_flag.value, shared_dedup_filter())
+
+
+class SpiderFleet(object):
+    """
+    reuse_port为True时所有worker绑定同一端口（需Linux 3.9+），否则依次使用bind_port + i
+    """
+
+    def __init__(self, bind_ip, bind_port, worker_count, max_node_size, reuse_port=True):
+        self.bind_ip = bind_ip
+        self.bind_port = bind_port
+        self.worker_count = worker_count
+        self.max_node_size = max_node_size
+        self.reuse_port = reuse_port
+
+        self.isFleetWorking = True
+        self.metadata_queue = multiprocessing.Queue(maxsize=METADATA_QUEUE_SIZE)  # 满时worker等待recorder
+        # 停止标志用无锁的共享内存值，避免被强制杀死的worker在Event内部锁上留下死锁
+        self.worker_stop_flag = multiprocessing.RawValue('b', 0)
+        self.recorder_stop_flag = multiprocessing.RawValue('b', 0)
+        self.workers = [None] * worker_count
+        self.recorder = None
+
+    def start_worker(self, index):
+        port = self.bind_port if self.reuse_port else self.bind_port + index
+        worker = multiprocessing.Process(target=run_worker,
+                                         args=(self.bind_ip, port, self.max_node_size, self.reuse_port,
+                                               self.metadata_queue, self.worker_stop_flag))
+        worker.daemon = True
+        worker.start()
+        self.workers[index] = worker
+
+    def run(self, duration=None):
+        """运行到duration秒后或收到SIGINT/SIGTERM时退出，期间重启意外退出的worker"""
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        shared_dedup_filter()  # fork之前创建并预加载，子进程继承同一份共享映射
+        self.recorder = multiprocessing.Process(target=run_recorder,
+                                                args=(self.metadata_queue, self.recorder_stop_flag))
+        self.recorder.start()
+
+        begin = time()
+        try:
+            for i in xrange(self.worker_count):
+                self.start_worker(i)
+                sleep(1)
+            while self.isFleetWorking and (duration is None or time() - begin < duration):
+                for i, worker in enumerate(self.workers):
+                    if not worker.is_alive():
+                        # print('worker %d exited with %s, restarting' % (i, worker.exitcode))
+                        self.start_worker(i)
+                sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+    def stop(self):
+        self.isFleetWorking = False
+
+    def shutdown(self):
+        # 先停worker，待其退出后再通知recorder取完队列中剩余数据
+        self.worker_stop_flag.value = 1
+        for worker in self.workers:
+            if worker is None:
+                continue
+            worker.join(30)
+            if worker.is_alive():
+                worker.terminate()
+        self.recorder_stop_flag.value = 1
+        self.recorder.join()
+
+
+if __name__ == '__main__':
+    SpiderFleet('0.0.0.0', 8087, multiprocessing.cpu_count(), max_node_size=1500).run(60 * 60 * 8)  # 持续运行一段时间
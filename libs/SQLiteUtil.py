@@ -1,42 +1,77 @@
 # encoding: utf-8
-# sqlite3单线程操作工具类
+# sqlite3连接池工具类：一个长连接负责写（串行），若干长连接负责读（WAL模式下可与写并发）
+import os.path
 import sqlite3
 import Queue
+from threading import Lock
 
 
-def singleton(cls):
+def shared_per_path(cls):
+    """
+    同一数据库文件在进程内共享一个实例（只有一个写连接，避免进程内的写事务互相等待锁），不同文件各自独立
+    已有实例时沿用其建立时的 pragmas 等参数；实例关闭后再次构造时重新建立
+    """
     instances = {}
+    lock = Lock()
 
-    def _singleton(*args, **kw):
-        if cls not in instances:
-            instances[cls] = cls(*args, **kw)
-        return instances[cls]
+    def _shared(path, *args, **kw):
+        key = path if path == ':memory:' else os.path.abspath(path)
+        with lock:
+            if key not in instances or instances[key].closed:
+                instances[key] = cls(path, *args, **kw)
+            return instances[key]
 
-    return _singleton
+    return _shared
 
 
-@singleton
+@shared_per_path
 class SQLiteUtil(object):
-    __queue_conn = Queue.Queue(maxsize=1)
-    __path = None
 
-    def __init__(self, path):
+    def __init__(self, path, pragmas=(), reader_count=4, cached_statements=256):
+        """
+        pragmas 在每个连接建立时执行，例如 ('journal_mode=WAL', 'synchronous=NORMAL')
+        cached_statements 为每个连接的预编译语句缓存大小
+        """
         self.__path = path
-        self.__create_conn()
+        self.__pragmas = pragmas
+        self.__cached_statements = cached_statements
+        self.__writer_queue = Queue.Queue(maxsize=1)
+        self.__reader_queue = Queue.Queue(maxsize=reader_count)
+        self.closed = False
+
+        self.__writer_queue.put(self.__create_conn())
+        for _ in xrange(reader_count):
+            self.__reader_queue.put(self.__create_conn())
 
     def __create_conn(self):
-        conn = sqlite3.connect(self.__path, check_same_thread=False)
-        self.__queue_conn.put(conn)
+        conn = sqlite3.connect(self.__path, check_same_thread=False, cached_statements=self.__cached_statements)
+        for pragma in self.__pragmas:
+            conn.execute('pragma %s;' % pragma)
+        return conn
 
-    def __close(self, cursor, conn):
-        if cursor is not None:
-            cursor.close()
-        if conn is not None:
-            cursor.close()
-            self.__create_conn()
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """等待正在使用的连接归还后关闭所有连接"""
+        if self.closed:
+            return
+        self.closed = True
+        self.__writer_queue.get().close()
+        for _ in xrange(self.__reader_queue.maxsize):
+            self.__reader_queue.get().close()
+
+    def __get_conn(self, conn_queue):
+        """关闭后连接已不在队列中，直接报错而不是永远等待"""
+        if self.closed:
+            raise sqlite3.ProgrammingError('SQLiteUtil is closed')
+        return conn_queue.get()
 
     def execute_query(self, sql, params):
-        conn = self.__queue_conn.get()
+        conn = self.__get_conn(self.__reader_queue)
         cursor = conn.cursor()
         value = None
         try:
@@ -48,11 +83,31 @@ class SQLiteUtil(object):
             field = [i[0] for i in cursor.description]
             value = [dict(zip(field, i)) for i in records]
         finally:
-            self.__close(cursor, conn)
+            cursor.close()
+            self.__reader_queue.put(conn)
         return value
 
+    def iter_query(self, sql, params, batch_size=10000):
+        """逐批取出结果行(元组)，适合遍历大表，遍历期间占用一个读连接"""
+        conn = self.__get_conn(self.__reader_queue)
+        cursor = conn.cursor()
+        try:
+            if params is not None:
+                cursor.execute(sql, params)
+            else:
+                cursor.execute(sql)
+            while True:
+                records = cursor.fetchmany(batch_size)
+                if not records:
+                    break
+                for record in records:
+                    yield record
+        finally:
+            cursor.close()
+            self.__reader_queue.put(conn)
+
     def executescript(self, sql):
-        conn = self.__queue_conn.get()
+        conn = self.__get_conn(self.__writer_queue)
         cursor = conn.cursor()
         try:
             cursor.executescript(sql)
@@ -61,13 +116,47 @@ class SQLiteUtil(object):
             conn.rollback()
             raise
         finally:
-            self.__close(cursor, conn)
+            cursor.close()
+            self.__writer_queue.put(conn)
 
     def execute(self, sql, params):
         return self.execute_many([sql], [params])
 
+    def execute_batch(self, sql, params_list):
+        """同一条语句批量执行，在一个事务内提交"""
+        conn = self.__get_conn(self.__writer_queue)
+        cursor = conn.cursor()
+        try:
+            count = cursor.executemany(sql, params_list).rowcount
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            self.__writer_queue.put(conn)
+        return count
+
+    def execute_batches(self, batches):
+        """batches 为 (sql, params_list) 列表，各语句分别批量执行，全部在一个事务内提交"""
+        conn = self.__get_conn(self.__writer_queue)
+        cursor = conn.cursor()
+        count = 0
+        try:
+            for sql, params_list in batches:
+                if params_list:
+                    count += cursor.executemany(sql, params_list).rowcount
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            self.__writer_queue.put(conn)
+        return count
+
     def execute_many(self, sql_list, params_list):
-        conn = self.__queue_conn.get()
+        conn = self.__get_conn(self.__writer_queue)
         cursor = conn.cursor()
         count = 0
         try:
@@ -83,5 +172,6 @@ class SQLiteUtil(object):
             conn.rollback()
             raise
         finally:
-            self.__close(cursor, conn)
+            cursor.close()
+            self.__writer_queue.put(conn)
         return count
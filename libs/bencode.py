@@ -25,6 +25,8 @@ def decode_int(x, f):
 def decode_string(x, f):
     colon = x.index(':', f)
     n = int(x[f:colon])
+    if n < 0:
+        raise ValueError  # a negative length would move f backwards and loop forever
     if x[f] == '0' and colon != f+1:
         raise ValueError
     colon += 1
@@ -33,17 +35,44 @@ def decode_string(x, f):
 def decode_list(x, f):
     r, f = [], f+1
     while x[f] != 'e':
-        v, f = decode_func[x[f]](x, f)
-        r.append(v)
+        if x[f] in DIGITS:
+            # strings are by far the most common value, decode them inline
+            colon = x.index(':', f)
+            if x[f] == '0' and colon != f+1:
+                raise ValueError
+            newf = colon + 1 + int(x[f:colon])
+            r.append(x[colon+1:newf])
+            f = newf
+        else:
+            v, f = decode_func[x[f]](x, f)
+            r.append(v)
     return (r, f + 1)
 
 def decode_dict(x, f):
     r, f = {}, f+1
     while x[f] != 'e':
-        k, f = decode_string(x, f)
-        r[k], f = decode_func[x[f]](x, f)
+        # keys must be strings; checking the first digit also rules out negative lengths
+        if x[f] not in DIGITS:
+            raise ValueError
+        colon = x.index(':', f)
+        if x[f] == '0' and colon != f+1:
+            raise ValueError
+        newf = colon + 1 + int(x[f:colon])
+        k = x[colon+1:newf]
+        f = newf
+        if x[f] in DIGITS:
+            colon = x.index(':', f)
+            if x[f] == '0' and colon != f+1:
+                raise ValueError
+            newf = colon + 1 + int(x[f:colon])
+            r[k] = x[colon+1:newf]
+            f = newf
+        else:
+            r[k], f = decode_func[x[f]](x, f)
     return (r, f + 1)
 
+DIGITS = '0123456789'
+
 decode_func = {}
 decode_func['l'] = decode_list
 decode_func['d'] = decode_dict
@@ -59,13 +88,25 @@ decode_func['7'] = decode_string
 decode_func['8'] = decode_string
 decode_func['9'] = decode_string
 
-def bdecode(x):
+def bdecode(x, strict=False):
+    if isinstance(x, memoryview):
+        x = x.tobytes()
     try:
         r, l = decode_func[x[0]](x, 0)
     except (IndexError, KeyError, ValueError):
         raise Exception("not a valid bencoded string")
-    #if l != len(x):
-    #    raise Exception("invalid bencoded value (data after valid prefix)")
+    if strict and l != len(x):
+        raise Exception("invalid bencoded value (data after valid prefix)")
+    return r
+
+def bdecode_many(packets, strict=False):
+    """Decode a batch of packets; entries that fail to decode come back as None."""
+    r = []
+    for x in packets:
+        try:
+            r.append(bdecode(x, strict))
+        except Exception:
+            r.append(None)
     return r
 
 from types import StringType, IntType, LongType, DictType, ListType, TupleType
@@ -127,3 +168,78 @@ def bencode(x):
     r = []
     encode_func[type(x)](x, r)
     return ''.join(r)
+
+
+if __name__ == '__main__':
+    # Self-check: malformed inputs that once hung the decoder, then a seeded fuzz run.
+    # Every input must decode or raise within the alarm; valid values must round-trip.
+    import random
+    import signal
+
+    if hasattr(signal, 'alarm'):
+        signal.alarm(60)  # a decoder that loops forever fails the run instead of hanging it
+
+    MALFORMED = [
+        'd1:a1:z-6:',  # negative key length jumped backwards (one 10-byte UDP packet hung the receiver)
+        'd1:a1:z-6:e',
+        'l-6:ae',
+        '-6:abc',
+        'd1:a-1:e',
+        'di1e1:ae',  # non-string key
+        'd1:ae',
+        'i-0e',
+        'i03e',
+        '03:abc',
+        'l',
+        'd',
+        '',
+        '5:abc',
+    ]
+    for x in MALFORMED:
+        try:
+            bdecode(x, strict=True)
+        except Exception:
+            continue
+        raise AssertionError('accepted malformed input %r' % x)
+
+    rng = random.Random(0)
+
+    def random_string():
+        return ''.join(chr(rng.getrandbits(8)) for _ in xrange(rng.randint(0, 12)))
+
+    def random_value(depth=0):
+        kind = rng.randint(0, 3 if depth < 3 else 1)
+        if kind == 0:
+            return rng.randint(-1000, 1000)
+        if kind == 1:
+            return random_string()
+        if kind == 2:
+            return [random_value(depth + 1) for _ in xrange(rng.randint(0, 4))]
+        return dict((random_string(), random_value(depth + 1)) for _ in xrange(rng.randint(0, 4)))
+
+    def mutate(x):
+        x = list(x)
+        for _ in xrange(rng.randint(1, 3)):
+            op = rng.randint(0, 3)
+            i = rng.randint(0, len(x))
+            if op == 0 and x:
+                del x[min(i, len(x) - 1)]
+            elif op == 1:
+                x.insert(i, rng.choice('-0123456789:ilde'))
+            elif op == 2 and x:
+                x[min(i, len(x) - 1)] = chr(rng.getrandbits(8))
+            else:
+                x = x[:i]
+        return ''.join(x)
+
+    cases = 20000
+    for _ in xrange(cases):
+        value = random_value()
+        encoded = bencode(value)
+        assert bdecode(encoded, strict=True) == value, encoded
+        mutated = mutate(encoded)
+        try:
+            bdecode(mutated)
+        except Exception:
+            pass
+    print('%d malformed inputs rejected, %d fuzz cases passed' % (len(MALFORMED), cases))
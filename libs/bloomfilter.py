@@ -0,0 +1,226 @@
+# encoding: utf-8
+# 布隆过滤器、持久化去重过滤器与已入库infohash精确集合
+import ctypes
+import hashlib
+import mmap
+import os
+from heapq import merge
+from struct import pack, unpack, calcsize
+from threading import Lock
+from time import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# 简化版布隆过滤器
+class BloomFilter(object):
+    """
+    位数组存放在 bytearray 中，置位时原地修改，也可以传入 bits 使用外部内存（如 mmap 上的 ctypes 数组）
+    k 个位置由一次 md5(C实现，128位) 摘要拆成的两个64位值双重哈希得到: h1 + i * h2
+    """
+
+    def __init__(self, size, hash_count, bits=None):
+        self.bits = bytearray((size + 7) // 8) if bits is None else bits  # 初始化
+        self.size = size
+        self.hash_count = hash_count
+
+    def indexes(self, item):
+        h1, h2 = unpack('<QQ', hashlib.md5(item).digest())
+        return [(h1 + i * h2) % self.size for i in xrange(self.hash_count)]
+
+    def contains(self, item):
+        bits = self.bits
+        for index in self.indexes(item):
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+    def add(self, item):
+        """如果是新的则置位并返回True"""
+        bits = self.bits
+        is_new = False
+        for index in self.indexes(item):
+            mask = 1 << (index & 7)
+            if not bits[index >> 3] & mask:
+                bits[index >> 3] |= mask
+                is_new = True
+        return is_new
+
+    def add_many(self, items):
+        return [self.add(item) for item in items]
+
+    def contains_many(self, items):
+        return [self.contains(item) for item in items]
+
+
+class KnownInfohashes(object):
+    """
+    已入库 infohash 的精确集合，只在布隆过滤器判断"可能存在"时查询
+    启动时按序加载为一整块 20 字节记录组成的有序串，二分查找，每条只占 20 字节；之后新增的放在 set 中，积累过多时合并
+    lookup 为可选的回退查询（如查数据库），精确集合中没有时调用，命中的结果加入集合
+    """
+
+    def __init__(self, lookup=None, merge_threshold=100000):
+        self.records = ''
+        self.recent = set()
+        self.lookup = lookup
+        self.merge_threshold = merge_threshold
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.records) // 20 + len(self.recent)
+
+    def load_sorted(self, infohashes):
+        """infohashes 需按升序给出，例如 select hash from matadata order by hash"""
+        records = bytearray()
+        for infohash in infohashes:
+            records.extend(infohash)
+        with self.lock:
+            self.records = str(records)
+
+    def search(self, infohash):
+        records = self.records
+        lo, hi = 0, len(records) // 20
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = records[mid * 20:mid * 20 + 20]
+            if record < infohash:
+                lo = mid + 1
+            elif record > infohash:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def contains(self, infohash):
+        if infohash in self.recent or self.search(infohash):
+            return True
+        if self.lookup is not None and self.lookup(infohash):
+            self.add(infohash)
+            return True
+        return False
+
+    def add(self, infohash):
+        self.recent.add(infohash)
+        if len(self.recent) >= self.merge_threshold:
+            with self.lock:
+                if len(self.recent) >= self.merge_threshold:
+                    recent, self.recent = self.recent, set()
+                    existing = (self.records[i:i + 20] for i in xrange(0, len(self.records), 20))
+                    records = bytearray()
+                    for infohash in merge(existing, sorted(recent)):
+                        if records[-20:] != infohash:
+                            records.extend(infohash)
+                    self.records = str(records)
+
+
+DEDUP_MAGIC = 'BTDF'
+DEDUP_VERSION = 1
+DEDUP_HEADER = '<4sIIIIIId'  # magic, version, hash_count, stored_bits, generation_bits, generation_count, current, rotated_at
+DEDUP_HEADER_SIZE = 64
+
+
+class DedupFilter(object):
+    """
+    进程间共享、重启后保留的去重过滤器，数据文件通过 mmap 映射，多个进程可以同时打开同一文件
+    stored 部分记录已入库的 infohash，不会过期；其余为按时间轮换的若干代，记录近期已调度获取的 infohash，
+    每隔 generation_interval 秒清空最旧的一代，获取失败的 infohash 在全部轮换一遍后可以再次获取
+    created 为 True 表示数据文件是新建的，需要调用方从数据库预加载已入库的 infohash
+    known 为可选的 KnownInfohashes，用于排除 stored 部分的误判
+    """
+
+    def __init__(self, path, stored_bits=1 << 26, generation_bits=1 << 23, generation_count=4,
+                 generation_interval=15 * 60, hash_count=7, known=None):
+        self.path = path
+        self.known = known
+        self.hash_count = hash_count
+        self.stored_bits = stored_bits
+        self.generation_bits = generation_bits
+        self.generation_count = generation_count
+        self.generation_interval = generation_interval
+        self.lock = Lock()
+
+        stored_bytes = (stored_bits + 7) // 8
+        generation_bytes = (generation_bits + 7) // 8
+        file_size = DEDUP_HEADER_SIZE + stored_bytes + generation_bytes * generation_count
+
+        self.file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        self.created = os.fstat(self.file.fileno()).st_size != file_size
+        if self.created:
+            self.file.truncate(0)
+            self.file.truncate(file_size)
+        self.mm = mmap.mmap(self.file.fileno(), file_size)
+        if not self.created and self.read_header()[:6] != (DEDUP_MAGIC, DEDUP_VERSION, hash_count, stored_bits,
+                                                           generation_bits, generation_count):
+            self.created = True
+            ctypes.memset(ctypes.addressof((ctypes.c_ubyte * file_size).from_buffer(self.mm)), 0, file_size)
+        if self.created:
+            self.write_header(0, time())
+
+        self.stored = BloomFilter(stored_bits, hash_count,
+                                  (ctypes.c_ubyte * stored_bytes).from_buffer(self.mm, DEDUP_HEADER_SIZE))
+        self.generations = []
+        for i in xrange(generation_count):
+            offset = DEDUP_HEADER_SIZE + stored_bytes + generation_bytes * i
+            self.generations.append(BloomFilter(generation_bits, hash_count,
+                                                (ctypes.c_ubyte * generation_bytes).from_buffer(self.mm, offset)))
+
+    def read_header(self):
+        return unpack(DEDUP_HEADER, self.mm[:calcsize(DEDUP_HEADER)])
+
+    def write_header(self, current, rotated_at):
+        self.mm[:calcsize(DEDUP_HEADER)] = pack(DEDUP_HEADER, DEDUP_MAGIC, DEDUP_VERSION, self.hash_count,
+                                                self.stored_bits, self.generation_bits, self.generation_count,
+                                                current, rotated_at)
+
+    def current_generation(self):
+        """到期时清空最旧的一代作为新的当前代，用文件锁避免多个进程重复轮换"""
+        current, rotated_at = self.read_header()[6:]
+        if time() - rotated_at < self.generation_interval:
+            return self.generations[current]
+        with self.lock:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+            try:
+                current, rotated_at = self.read_header()[6:]
+                if time() - rotated_at >= self.generation_interval:
+                    current = (current + 1) % self.generation_count
+                    bits = self.generations[current].bits
+                    ctypes.memset(ctypes.addressof(bits), 0, ctypes.sizeof(bits))
+                    self.write_header(current, time())
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        return self.generations[current]
+
+    def is_stored(self, infohash):
+        return self.stored.contains(infohash) and (self.known is None or self.known.contains(infohash))
+
+    def contains(self, infohash):
+        if self.is_stored(infohash):
+            return True
+        for generation in self.generations:
+            if generation.contains(infohash):
+                return True
+        return False
+
+    def add(self, infohash):
+        """记录一次调度，infohash 已入库或近期已调度过时返回False"""
+        generation = self.current_generation()
+        if self.is_stored(infohash):
+            return False
+        for other in self.generations:
+            if other is not generation and other.contains(infohash):
+                return False
+        return generation.add(infohash)
+
+    def add_stored(self, infohash):
+        self.stored.add(infohash)
+        if self.known is not None:
+            self.known.add(infohash)
+
+    def flush(self):
+        self.mm.flush()
@@ -0,0 +1,197 @@
+# encoding: utf-8
+# 有界队列及过载策略，用于receiver、inquirer、recorder之间的缓冲，生产过快时按策略丢弃而不是无限增长
+from Queue import Empty, Full
+from collections import OrderedDict, deque
+from heapq import heapify, heappop, heappush
+from threading import Condition, Lock
+from time import time
+
+BLOCK = 'block'  # 满时put阻塞，与Queue(maxsize)相同，用于不能丢弃的数据
+DROP_OLDEST = 'drop_oldest'  # 满时丢弃最旧的
+DROP_DUPLICATE = 'drop_duplicate'  # 丢弃key已在队列中的新数据，满时丢弃最旧的
+PRIORITY = 'priority'  # 相同key合并并累计次数，次数多的先出队；满时丢弃新数据，除非最旧的已过期
+
+
+class BoundedQueue(object):
+    """
+    与Queue相同的put/get接口，除BLOCK外put从不阻塞，返回是否接收
+    key 为从数据中取去重/合并键的函数，DROP_DUPLICATE与PRIORITY需要
+    max_age 秒后仍未取出的数据在get时丢弃，避免处理早已失效的数据
+    PRIORITY下 merge(旧数据, 新数据) 返回合并后的数据，不指定时保留旧数据；
+    hold 为新key的聚合窗口，首次入队hold秒后才可出队，期间的相同key都合并进来，使次数能反映热度
+    stats() 返回当前长度、高水位及各类丢弃计数
+    """
+
+    def __init__(self, maxsize, policy=DROP_OLDEST, key=None, max_age=None, merge=None, hold=0):
+        if policy in (DROP_DUPLICATE, PRIORITY) and key is None:
+            raise ValueError('policy %s requires a key function' % policy)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.key = key
+        self.max_age = max_age
+        self.merge = merge
+        self.hold = hold
+        self.items = deque()  # (入队时间, key, 数据)
+        self.keys = set()
+        self.entries = OrderedDict()  # PRIORITY: key -> [次数, 序号, 最近入队时间, 数据, 首次入队时间]，按首次入队排序
+        self.holding = OrderedDict()  # PRIORITY: 仍在聚合窗口内的key -> 同一entry，不在堆中
+        self.heap = []  # PRIORITY: (-次数, 序号, key)，次数变化时重新压入，出队时跳过过时的记录
+        self.sequence = 0
+        self.mutex = Lock()
+        self.not_empty = Condition(self.mutex)
+        self.not_full = Condition(self.mutex)
+
+        self.high_water_mark = 0
+        self.accepted = 0
+        self.dropped = 0  # 队列满被丢弃（新数据或被挤出的旧数据）
+        self.merged = 0  # 与队列中已有的相同key合并或作为重复丢弃
+        self.expired = 0  # 超过max_age未取出
+
+    def __len__(self):
+        return len(self.entries) if self.policy == PRIORITY else len(self.items)
+
+    def qsize(self):
+        return len(self)
+
+    def put(self, item, block=True, timeout=None):
+        with self.mutex:
+            if self.policy == PRIORITY:
+                if not self.put_priority(item):
+                    return False
+            else:
+                key = None
+                if self.policy == DROP_DUPLICATE:
+                    key = self.key(item)
+                    if key in self.keys:
+                        self.merged += 1
+                        return False
+                if self.policy == BLOCK:
+                    self.wait(self.not_full, lambda: len(self.items) < self.maxsize, block, timeout, Full)
+                while len(self.items) >= self.maxsize:
+                    self.pop_item()
+                    self.dropped += 1
+                self.items.append((time(), key, item))
+                if key is not None:
+                    self.keys.add(key)
+            self.accepted += 1
+            self.high_water_mark = max(self.high_water_mark, len(self))
+            self.not_empty.notify()
+        return True
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+    def put_priority(self, item):
+        key = self.key(item)
+        now = time()
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry[0] += 1
+            entry[2] = now
+            if self.merge is not None:
+                entry[3] = self.merge(entry[3], item)
+            if key not in self.holding:
+                heappush(self.heap, (-entry[0], entry[1], key))
+                self.compact_heap()
+            self.merged += 1
+            return False
+        if len(self.entries) >= self.maxsize:
+            oldest_key, oldest = next(self.entries.iteritems())
+            if self.max_age is None or now - oldest[2] <= self.max_age:
+                self.dropped += 1
+                return False
+            del self.entries[oldest_key]
+            self.holding.pop(oldest_key, None)
+            self.expired += 1
+        self.sequence += 1
+        self.entries[key] = entry = [1, self.sequence, now, item, now]
+        if self.hold > 0:
+            self.holding[key] = entry
+        else:
+            heappush(self.heap, (-1, self.sequence, key))
+            self.compact_heap()
+        return True
+
+    def compact_heap(self):
+        if len(self.heap) > 2 * len(self.entries) + 64:  # 合并产生的过时记录过多时重建堆
+            self.heap = [(-entry[0], entry[1], key) for key, entry in self.entries.iteritems()
+                         if key not in self.holding]
+            heapify(self.heap)
+
+    def release_held(self):
+        """聚合窗口已结束的key移入堆中"""
+        deadline = time() - self.hold
+        while self.holding:
+            key, entry = next(self.holding.iteritems())
+            if entry[4] > deadline:
+                break
+            del self.holding[key]
+            heappush(self.heap, (-entry[0], entry[1], key))
+
+    def ready_count(self):
+        return len(self.entries) - len(self.holding) if self.policy == PRIORITY else len(self.items)
+
+    def get(self, block=True, timeout=None):
+        with self.mutex:
+            self.wait(self.not_empty, self.drop_expired, block, timeout, Empty, self.hold or None)
+            item = self.pop_item()
+            self.not_full.notify()
+            return item
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def wait(self, condition, is_ready, block, timeout, exception, interval=None):
+        """interval 为最长等待间隔，数据可能随时间变为可用（聚合窗口结束）而不会有通知"""
+        if not block:
+            if not is_ready():
+                raise exception
+        elif timeout is None:
+            while not is_ready():
+                condition.wait(interval)
+        else:
+            end_time = time() + timeout
+            while not is_ready():
+                remaining = end_time - time()
+                if remaining <= 0:
+                    raise exception
+                condition.wait(remaining if interval is None else min(remaining, interval))
+
+    def drop_expired(self):
+        """丢弃队首已过期的数据，返回队列是否还有可出队的数据"""
+        if self.holding:
+            self.release_held()
+        if self.max_age is not None:
+            deadline = time() - self.max_age
+            while self.ready_count() > 0 and self.peek_time() < deadline:
+                self.pop_item()
+                self.expired += 1
+        return self.ready_count() > 0
+
+    def peek_time(self):
+        if self.policy != PRIORITY:
+            return self.items[0][0]
+        while True:
+            count, sequence, key = self.heap[0]
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == -count and entry[1] == sequence:
+                return entry[2]
+            heappop(self.heap)
+
+    def pop_item(self):
+        if self.policy != PRIORITY:
+            _, key, item = self.items.popleft()
+            if key is not None:
+                self.keys.discard(key)
+            return item
+        while True:
+            count, sequence, key = heappop(self.heap)
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == -count and entry[1] == sequence:
+                del self.entries[key]
+                return entry[3]
+
+    def stats(self):
+        with self.mutex:
+            return {'size': len(self), 'high_water_mark': self.high_water_mark, 'accepted': self.accepted,
+                    'dropped': self.dropped, 'merged': self.merged, 'expired': self.expired}
@@ -0,0 +1,181 @@
+# encoding: utf-8
+# 元数据(info字典)的单遍流式解析：只取出需要的字段，pieces 等大字段直接跳过，不构造完整的对象树
+from bencode import DIGITS
+
+MAX_LENGTH = (1 << 63) - 1  # sqlite INTEGER 的上限，超出的长度写库时会抛出 OverflowError
+
+
+def read_string(x, f):
+    if x[f] not in DIGITS:
+        raise ValueError  # 负数长度会使位置回退而死循环
+    colon = x.index(':', f)
+    if x[f] == '0' and colon != f + 1:
+        raise ValueError
+    end = colon + 1 + int(x[f:colon])
+    if end > len(x):
+        raise ValueError  # 截断的字符串
+    return x[colon + 1:end], end
+
+
+def read_int(x, f):
+    end = x.index('e', f + 1)
+    return int(x[f + 1:end]), end + 1
+
+
+def skip_value(x, f):
+    """跳过任意一个值，返回其后的位置；用计数代替递归，畸形的深层嵌套也不会超出递归深度"""
+    depth = 0
+    while True:
+        c = x[f]
+        if c in DIGITS:
+            f = read_string(x, f)[1]
+        elif c == 'i':
+            f = x.index('e', f + 1) + 1
+        elif c == 'l' or c == 'd':
+            depth += 1
+            f += 1
+            continue
+        elif c == 'e' and depth > 0:
+            depth -= 1
+            f += 1
+        else:
+            raise ValueError
+        if depth == 0:
+            return f
+
+
+def read_path(x, f):
+    """path为字符串列表，各级以'/'连接"""
+    if x[f] != 'l':
+        return None, skip_value(x, f)
+    begin = f
+    parts, f = [], f + 1
+    while x[f] != 'e':
+        if x[f] not in DIGITS:
+            return None, skip_value(x, begin)  # 畸形path整体跳过
+        # 文件较多时这里是最频繁的调用，内联read_string
+        colon = x.index(':', f)
+        if x[f] == '0' and colon != f + 1:
+            raise ValueError
+        f = colon + 1 + int(x[f:colon])
+        parts.append(x[colon + 1:f])
+    if f > len(x):
+        raise ValueError
+    return '/'.join(parts), f + 1
+
+
+def read_file(x, f):
+    """files列表中的一项，返回 (path, length)，缺少length时length为None，缺少path时path为空串"""
+    if x[f] != 'd':
+        return None, skip_value(x, f)
+    path, path_utf8, length, f = None, None, None, f + 1
+    while x[f] != 'e':
+        if x[f] not in DIGITS:
+            raise ValueError
+        colon = x.index(':', f)
+        if x[f] == '0' and colon != f + 1:
+            raise ValueError
+        f = colon + 1 + int(x[f:colon])
+        key = x[colon + 1:f]
+        if key == 'length' and x[f] == 'i':
+            end = x.index('e', f + 1)
+            length, f = int(x[f + 1:end]), end + 1
+        elif key == 'path':
+            path, f = read_path(x, f)
+        elif key == 'path.utf-8':
+            path_utf8, f = read_path(x, f)
+        else:
+            f = skip_value(x, f)
+    return (path_utf8 or path or '', length), f + 1
+
+
+def parse_info(x):
+    """
+    解析info字典，返回:
+    {
+      "name": "种子名称",       # 优先取name.utf-8，原始字节串
+      "size": 18679173,        # 单文件取length，多文件为各文件length之和
+      "file_count": 1,
+      "piece_length": 262144,
+      "files": [("目录/文件名", 18679173), ...],   # 单文件时为 [(name, length)]
+      "truncated": False
+    }
+    只读取info字典顶层的键，路径或其他字段中出现的"name"、"length"不会干扰结果
+    负数或超过 MAX_LENGTH 的长度视为无效而忽略，各文件之和超过 MAX_LENGTH 时 size 取 MAX_LENGTH
+    数据截断或格式错误时停止解析，返回已解析出的部分并把truncated置为True，不抛出异常
+    """
+    info = {'name': None, 'size': 0, 'file_count': 0, 'piece_length': 0, 'files': [], 'truncated': False}
+    name = name_utf8 = length = None
+    try:
+        if x[0] != 'd':
+            raise ValueError
+        f = 1
+        while x[f] != 'e':
+            key, f = read_string(x, f)
+            c = x[f]
+            if key == 'name' and c in DIGITS:
+                name, f = read_string(x, f)
+            elif key == 'name.utf-8' and c in DIGITS:
+                name_utf8, f = read_string(x, f)
+            elif key == 'length' and c == 'i':
+                length, f = read_int(x, f)
+            elif key == 'piece length' and c == 'i':
+                info['piece_length'], f = read_int(x, f)
+            elif key == 'files' and c == 'l':
+                f += 1
+                while x[f] != 'e':
+                    item, f = read_file(x, f)
+                    if item is not None and item[1] is not None and 0 <= item[1] <= MAX_LENGTH:
+                        info['files'].append(item)
+                f += 1
+            else:
+                f = skip_value(x, f)
+    except (IndexError, ValueError):
+        info['truncated'] = True
+
+    info['name'] = name_utf8 or name
+    if not 0 <= info['piece_length'] <= MAX_LENGTH:
+        info['piece_length'] = 0
+    if info['files']:
+        info['size'] = min(sum(file_length for _, file_length in info['files']), MAX_LENGTH)
+    elif length is not None and 0 <= length <= MAX_LENGTH:
+        info['size'] = length
+        info['files'].append((info['name'], length))
+    info['file_count'] = len(info['files'])
+    return info
+
+
+if __name__ == '__main__':
+    # 自检：曾导致死循环的畸形输入，以及对正常info字典随机变异的模糊测试，每个输入都必须在限时内返回
+    import random
+    import signal
+
+    from bencode import bencode
+
+    if hasattr(signal, 'alarm'):
+        signal.alarm(60)
+
+    huge = bencode({'name': 'x', 'piece length': 1 << 64, 'files': [{'length': MAX_LENGTH, 'path': ['a']},
+                                                                 {'length': 1 << 63, 'path': ['b']},
+                                                                 {'length': 1, 'path': ['c']}]})
+    assert parse_info(huge)['size'] == MAX_LENGTH and parse_info(huge)['file_count'] == 2, parse_info(huge)
+    assert parse_info(huge)['piece_length'] == 0
+    assert parse_info(bencode({'name': 'x', 'length': 1 << 63}))['size'] == 0
+
+    MALFORMED = ['d4:name1:z-6:', 'd4:name1:z-6:e', 'd5:filesld-6:eee', 'd5:filesld4:pathl-6:aeeee', 'd4:name-1:']
+    for x in MALFORMED:
+        assert parse_info(x)['truncated'], x
+
+    rng = random.Random(0)
+    cases = 5000
+    for _ in xrange(cases):
+        files = [{'length': rng.randint(0, 1 << 40), 'path': ['dir', 'file%d' % i]} for i in xrange(rng.randint(1, 5))]
+        x = list(bencode({'name': 'test', 'piece length': 16384, 'files': files, 'pieces': 'x' * 20}))
+        for _ in xrange(rng.randint(1, 3)):
+            i = rng.randint(0, len(x) - 1)
+            if rng.random() < 0.5:
+                x.insert(i, rng.choice('-0123456789:ilde'))
+            else:
+                x[i] = chr(rng.getrandbits(8))
+        parse_info(''.join(x))
+    print('%d malformed inputs rejected, %d fuzz cases passed' % (len(MALFORMED), cases))
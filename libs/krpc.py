@@ -0,0 +1,61 @@
+# encoding: utf-8
+# 预编译的KRPC消息模板：固定部分只用bencode编码一次，之后每次只拼接可变字段
+import re
+
+from bencode import Bencached, bencode
+
+
+def field(name):
+    """模板中的可变字段占位符"""
+    return Bencached('\x00%s\x00' % name)
+
+
+class KRPCTemplate(object):
+    """
+    用 bencode 对含占位符的消息编码一次，按占位符切分得到各段固定字节串
+    render 时把字符串字段编码为 长度:内容 填入，结果与对完整消息调用 bencode 逐字节一致
+    """
+
+    def __init__(self, msg):
+        parts = re.split('\x00(\\w+)\x00', bencode(msg))
+        self.fields = parts[1::2]
+        self.format = '%d:%s'.join(part.replace('%', '%%') for part in parts[0::2])
+
+    def render(self, **values):
+        args = []
+        for name in self.fields:
+            value = values[name]
+            args.append(len(value))
+            args.append(value)
+        return self.format % tuple(args)
+
+
+PONG = KRPCTemplate({'t': field('t'), 'y': 'r', 'r': {'id': field('id')}})
+FIND_NODE_QUERY = KRPCTemplate({'t': field('t'), 'y': 'q', 'q': 'find_node',
+                                'a': {'id': field('id'), 'target': field('target')}})
+FIND_NODE_RESPONSE = KRPCTemplate({'t': field('t'), 'y': 'r', 'r': {'id': field('id'), 'nodes': field('nodes')}})
+GET_PEERS_RESPONSE = KRPCTemplate({'t': field('t'), 'y': 'r',
+                                   'r': {'id': field('id'), 'nodes': field('nodes'), 'token': field('token')}})
+
+
+if __name__ == '__main__':
+    # 与 bencode 的一致性校验及耗时对比
+    import os
+    import timeit
+
+    t, nid, nodes = os.urandom(2), os.urandom(20), os.urandom(26 * 8)
+    cases = [
+        ('pong', lambda: bencode({'t': t, 'y': 'r', 'r': {'id': nid}}),
+         lambda: PONG.render(t=t, id=nid)),
+        ('find_node query', lambda: bencode({'t': t, 'y': 'q', 'q': 'find_node', 'a': {'id': nid, 'target': nid}}),
+         lambda: FIND_NODE_QUERY.render(t=t, id=nid, target=nid)),
+        ('find_node response', lambda: bencode({'t': t, 'y': 'r', 'r': {'id': nid, 'nodes': nodes}}),
+         lambda: FIND_NODE_RESPONSE.render(t=t, id=nid, nodes=nodes)),
+        ('get_peers response', lambda: bencode({'t': t, 'y': 'r', 'r': {'id': nid, 'nodes': nodes, 'token': t}}),
+         lambda: GET_PEERS_RESPONSE.render(t=t, id=nid, nodes=nodes, token=t)),
+    ]
+    for name, generic, template in cases:
+        assert generic() == template(), name
+        generic_time = min(timeit.repeat(generic, number=20000, repeat=5)) / 20000 * 1e6
+        template_time = min(timeit.repeat(template, number=20000, repeat=5)) / 20000 * 1e6
+        print('%-20s bencode %.2f us, template %.2f us' % (name, generic_time, template_time))
@@ -0,0 +1,281 @@
+# encoding: utf-8
+# DHT节点的紧凑存储：节点统一以26字节(nid + ip + port)保存在预分配的bytearray中，不为每个节点创建对象
+import socket
+from array import array
+from struct import Struct, unpack
+from threading import Lock
+from time import time
+
+from bloomfilter import BloomFilter
+
+# 紧凑node格式: nid + ip + port，IPv4为26字节，BEP 32的IPv6为38字节
+NODE_STRUCT = Struct('!20s4sH')
+NODE_SIZE = NODE_STRUCT.size
+NODE6_STRUCT = Struct('!20s16sH')
+NODE6_SIZE = NODE6_STRUCT.size
+
+
+# node节点结构，只在需要按地址发送时临时创建
+class KNode(object):
+    __slots__ = ('nid', 'ip', 'port')
+
+    def __init__(self, nid, ip=None, port=None):
+        self.nid = nid
+        self.ip = ip
+        self.port = port
+
+    def __eq__(self, other):
+        return other.nid == self.nid
+
+    def __hash__(self):
+        return hash(self.nid)
+
+    @staticmethod
+    def decode_nodes(nodes):
+        """
+        解析node串，每个node长度为26，其中20位为nid，4位为ip，2位为port
+        ip保持4字节紧凑形式，需要时再用socket.inet_ntoa转换
+        数据格式: [ (node ID, packed ip, port),(node ID, packed ip, port).... ]
+        """
+        length = len(nodes)
+        if (length % NODE_SIZE) != 0:
+            return []
+        unpack_from = NODE_STRUCT.unpack_from
+        return [unpack_from(nodes, i) for i in xrange(0, length, NODE_SIZE)]
+
+    @staticmethod
+    def encode_nodes(nodes):
+        """KNode列表编码为紧凑node串，node.ip为点分十进制字符串"""
+        return ''.join([NODE_STRUCT.pack(node.nid, socket.inet_aton(node.ip), node.port) for node in nodes])
+
+    @staticmethod
+    def decode_nodes6(nodes6):
+        """
+        解析BEP 32的nodes6串，每个node长度为38，其中20位为nid，16位为ipv6地址，2位为port
+        数据格式: [ (node ID, packed ip, port),(node ID, packed ip, port).... ]
+        """
+        length = len(nodes6)
+        if (length % NODE6_SIZE) != 0:
+            return []
+        unpack_from = NODE6_STRUCT.unpack_from
+        return [unpack_from(nodes6, i) for i in xrange(0, length, NODE6_SIZE)]
+
+    @staticmethod
+    def encode_nodes6(nodes):
+        """KNode列表编码为紧凑nodes6串，node.ip为ipv6地址字符串"""
+        return ''.join([NODE6_STRUCT.pack(node.nid, socket.inet_pton(socket.AF_INET6, node.ip), node.port)
+                        for node in nodes])
+
+
+# 按node id前缀划分的k桶路由表
+class RoutingTable(object):
+    """
+    整个id空间按前缀均分为若干k桶，桶的数量由容量决定，桶内按最近活跃时间排序
+    桶满时淘汰最久未活跃且已超过stale_time的节点，否则丢弃新节点
+    所有桶预分配在一个bytearray中，第i个桶占第i*k到i*k+k个26字节槽位，活跃时间存放在并行的double数组中，
+    每个节点固定占用34字节，回复find_node/get_peers时直接切出紧凑格式拼接
+    另以按前缀二分的完全二叉树记录每个子树的节点数（堆式数组，叶子为各桶），查找最近节点时跳过空的子树
+    """
+
+    def __init__(self, capacity, k=8, stale_time=15 * 60):
+        bits = 0
+        while (k << bits) < capacity and bits < 32:
+            bits += 1
+        self.shift = 32 - bits
+        self.bucket_count = 1 << bits
+        self.entries = bytearray(self.bucket_count * k * NODE_SIZE)
+        self.last_seen = array('d', [0.0]) * (self.bucket_count * k)
+        self.counts = array('B', [0]) * self.bucket_count
+        self.bits = bits
+        self.subtree_counts = array('I', [0]) * (2 * self.bucket_count)  # 第n个子树的子树为2n与2n+1，桶i为叶子bucket_count+i
+        self.k = k
+        self.stale_time = stale_time
+        self.size = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        return self.size
+
+    def bucket_index(self, nid):
+        return unpack('!I', nid[:4])[0] >> self.shift
+
+    def remove_slot(self, slot, end):
+        """删除槽位slot，其后直到end的节点前移一位"""
+        entries = self.entries
+        entries[slot * NODE_SIZE:(end - 1) * NODE_SIZE] = entries[(slot + 1) * NODE_SIZE:end * NODE_SIZE]
+        self.last_seen[slot:end - 1] = self.last_seen[slot + 1:end]
+
+    def add(self, nid, ip, port):
+        """新增节点或刷新已有节点的活跃时间，ip为4字节紧凑形式，刷新或新增的节点移到桶尾"""
+        now = time()
+        with self.lock:
+            index = self.bucket_index(nid)
+            base = index * self.k
+            end = base + self.counts[index]
+            entries = self.entries
+            for slot in xrange(base, end):
+                if entries[slot * NODE_SIZE:slot * NODE_SIZE + 20] == nid:
+                    self.remove_slot(slot, end)
+                    end -= 1
+                    break
+            else:
+                if end - base >= self.k:
+                    if now - self.last_seen[base] < self.stale_time:
+                        return
+                    self.remove_slot(base, end)
+                    end -= 1
+                else:
+                    self.size += 1
+                    tree_index = self.bucket_count + index
+                    while tree_index:
+                        self.subtree_counts[tree_index] += 1
+                        tree_index >>= 1
+            entries[end * NODE_SIZE:(end + 1) * NODE_SIZE] = NODE_STRUCT.pack(nid, ip, port)
+            self.last_seen[end] = now
+            self.counts[index] = end + 1 - base
+
+    def nearest_buckets(self, index):
+        """
+        按与index的异或值递增的顺序生成非空的桶序号：从根向下每层先进入与index该位相同的子树，节点数为0的子树整个跳过
+        取够节点即停止时只访问O(层数 * 非空桶数)个树节点，与桶的总数无关
+        """
+        subtree_counts = self.subtree_counts
+        stack = [(1, self.bits - 1)]
+        while stack:
+            node, bit = stack.pop()
+            if not subtree_counts[node]:
+                continue
+            if bit < 0:
+                yield node - self.bucket_count
+                continue
+            near = (node << 1) | ((index >> bit) & 1)
+            stack.append((near ^ 1, bit - 1))
+            stack.append((near, bit - 1))
+
+    def closest(self, target, count=8):
+        """
+        返回与target异或距离最近的count个节点的紧凑格式
+        桶序号与target前缀的异或值越小距离越近，按该顺序取非空的桶，取够即可停止
+        """
+        index = self.bucket_index(target)
+        candidates = []
+        with self.lock:
+            entries = self.entries
+            for bucket in self.nearest_buckets(index):
+                begin = bucket * self.k * NODE_SIZE
+                end = begin + self.counts[bucket] * NODE_SIZE
+                candidates.extend(str(entries[offset:offset + NODE_SIZE])
+                                  for offset in xrange(begin, end, NODE_SIZE))
+                if len(candidates) >= count:
+                    break
+        if len(candidates) > 1:
+            target_value = long(target.encode('hex'), 16)
+            candidates.sort(key=lambda compact: long(compact[:20].encode('hex'), 16) ^ target_value)
+        return candidates[:count]
+
+
+# sniffer 待发送find_node的节点队列
+class NodeFrontier(object):
+    """
+    预分配的26字节槽位环形队列，满时覆盖最旧的节点而不是拒绝新节点，push/pop均为O(1)
+    按 (ip, port) 的6字节紧凑形式去重，两代布隆过滤器轮换，同一节点在一个窗口内只会入队一次（误判率约1%）
+    pop时才转换为KNode
+    """
+
+    def __init__(self, capacity, dedup_window=10 * 60):
+        self.capacity = capacity
+        self.entries = bytearray(capacity * NODE_SIZE)
+        self.head = 0
+        self.count = 0
+        self.dedup_window = dedup_window
+        self.dedup_capacity = capacity * 16
+        self.seen = self.new_generation()
+        self.last_seen = self.new_generation()
+        self.seen_count = 0
+        self.window_begin = time()
+        self.lock = Lock()
+
+    def __len__(self):
+        return self.count
+
+    def new_generation(self):
+        return BloomFilter(self.dedup_capacity * 10, 7)
+
+    def push(self, nid, ip, port):
+        """ip为4字节紧凑形式"""
+        key = ip + chr(port >> 8) + chr(port & 0xff)
+        with self.lock:
+            if self.seen_count >= self.dedup_capacity or time() - self.window_begin > self.dedup_window:
+                self.last_seen, self.seen = self.seen, self.new_generation()
+                self.seen_count = 0
+                self.window_begin = time()
+            if self.last_seen.contains(key) or not self.seen.add(key):
+                return False
+            self.seen_count += 1
+            slot = (self.head + self.count) % self.capacity
+            self.entries[slot * NODE_SIZE:(slot + 1) * NODE_SIZE] = NODE_STRUCT.pack(nid, ip, port)
+            if self.count < self.capacity:
+                self.count += 1
+            else:
+                self.head = (self.head + 1) % self.capacity
+        return True
+
+    def pop(self):
+        with self.lock:
+            if self.count == 0:
+                return None
+            nid, ip, port = NODE_STRUCT.unpack_from(self.entries, self.head * NODE_SIZE)
+            self.head = (self.head + 1) % self.capacity
+            self.count -= 1
+        return KNode(nid, socket.inet_ntoa(ip), port)
+
+
+if __name__ == '__main__':
+    # 每个节点占用的内存：逐个创建对象的旧结构与紧凑结构对比，以进程RSS增量计算
+    import os
+    import random
+    from collections import OrderedDict, deque
+
+    def rss():
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    class DictNode(object):
+        def __init__(self, nid, ip, port):
+            self.nid = nid
+            self.ip = ip
+            self.port = port
+
+    count = 200000
+    random.seed(0)
+    nodes = [(os.urandom(20), os.urandom(4), random.randint(1, 65535)) for _ in xrange(count)]
+    keep = []
+
+    def measure(name, build):
+        begin = rss()
+        keep.append(build())
+        print('%-32s %6.1f bytes/node' % (name, float(rss() - begin) / count))
+
+    measure('KNode with __dict__', lambda: [DictNode(nid, socket.inet_ntoa(ip), port) for nid, ip, port in nodes])
+    measure('KNode with __slots__', lambda: [KNode(nid, socket.inet_ntoa(ip), port) for nid, ip, port in nodes])
+    measure('OrderedDict buckets (old table)',
+            lambda: [OrderedDict((nid, (NODE_STRUCT.pack(nid, ip, port), time())) for nid, ip, port in nodes[i:i + 8])
+                     for i in xrange(0, count, 8)])
+    measure('deque + set dedup (old frontier)',
+            lambda: (deque(NODE_STRUCT.pack(*node) for node in nodes),
+                     set(NODE_STRUCT.pack(*node)[20:] for node in nodes)))
+
+    def build_table():
+        table = RoutingTable(count, stale_time=0)
+        for node in nodes:
+            table.add(*node)
+        return table
+
+    def build_frontier():
+        frontier = NodeFrontier(count)
+        for node in nodes:
+            frontier.push(*node)
+        return frontier
+
+    measure('RoutingTable', build_table)
+    measure('NodeFrontier', build_frontier)
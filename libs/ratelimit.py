@@ -0,0 +1,39 @@
+# encoding: utf-8
+# 令牌桶限速器，用于平滑发包速率
+from threading import Lock
+from time import sleep, time
+
+
+class TokenBucket(object):
+    """
+    rate 为每秒令牌数，burst 为桶容量（允许的瞬时突发数量）
+    acquire 预先扣除令牌，令牌不足时按欠额精确休眠，不以固定的时间片轮询
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time()
+        self.count = 0
+        self.count_begin = self.last
+        self.lock = Lock()
+
+    def acquire(self, tokens=1):
+        with self.lock:
+            now = time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate) - tokens
+            self.last = now
+            self.count += tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            sleep(wait)
+
+    def achieved_rate(self):
+        """返回自上次调用以来实际达到的每秒速率，并重新开始计数"""
+        with self.lock:
+            now = time()
+            rate = self.count / max(now - self.count_begin, 1e-6)
+            self.count = 0
+            self.count_begin = now
+        return rate